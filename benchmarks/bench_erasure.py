@@ -0,0 +1,37 @@
+#!/usr/bin/env python3.11
+# Reed-Solomon encode and decode throughput, in MB of file data per second.
+#
+#   python3 benchmarks/bench_erasure.py [group MB]
+import os
+import sys
+import time
+from os.path import dirname, abspath
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+from utils.erasure import ReedSolomon
+
+LAYOUTS = [(3, 2), (6, 3), (10, 4)]
+
+
+def rate(fn, size, rounds=5):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return rounds * size / (time.perf_counter() - start) / 1e6
+
+
+if __name__ == '__main__':
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else 6000000
+    data = os.urandom(size)
+    print('%8s %14s %22s %22s' % ('layout', 'encode MB/s', 'decode 1 lost MB/s', 'decode m lost MB/s'))
+    for k, m in LAYOUTS:
+        rs = ReedSolomon(k, m)
+        shards = rs.split(data)
+        parity = rs.encode(shards)
+        full = shards + parity
+        one = [None] + full[1:]
+        worst = [None] * m + full[m:]
+        print('%8s %14.1f %22.1f %22.1f' % ('RS(%d,%d)' % (k, m),
+                                            rate(lambda: rs.encode(shards), size),
+                                            rate(lambda: rs.decode(one), size),
+                                            rate(lambda: rs.decode(worst), size)))
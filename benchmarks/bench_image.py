@@ -0,0 +1,70 @@
+#!/usr/bin/env python3.11
+# NameNode startup time: YAML dump vs binary image.
+#
+#   python3 benchmarks/bench_image.py [entries] [--yaml]
+#
+# Builds a tree of 1000-file directories, each file with one chunk on two
+# chunk servers, writes it in both formats and times loading each. YAML
+# takes minutes past a few hundred thousand entries, so above YAML_LIMIT
+# only the binary image is timed unless --yaml is given.
+import os
+import sys
+import tempfile
+import time
+from os.path import dirname, abspath
+
+import yaml
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+from ns.name_server import FileNode, FsImage, NodeType
+
+FILES_PER_DIR = 1000
+YAML_LIMIT = 100000
+SERVERS = ['http://10.0.0.%d:9999' % i for i in range(1, 9)]
+
+
+def build(entries):
+    root = FileNode('/', NodeType.directory)
+    for i in range(entries):
+        d = i // FILES_PER_DIR
+        path = '/warehouse/part-%05d/file-%07d.parquet' % (d, i)
+        file = root.create_file(path)
+        file.size = 4096
+        file.add_chunk(path + '_0', [SERVERS[i % len(SERVERS)], SERVERS[(i + 1) % len(SERVERS)]])
+    return root
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if a != '--yaml']
+    entries = int(args[0]) if args else 100000
+    with_yaml = '--yaml' in sys.argv or entries <= YAML_LIMIT
+    root = build(entries)
+    with tempfile.TemporaryDirectory() as tmp:
+        img_path = os.path.join(tmp, 'metadata.img')
+        yml_path = os.path.join(tmp, 'metadata.yml')
+
+        with open(img_path, 'wb') as f:
+            f.write(FsImage.dumps(root, 0))
+        if with_yaml:
+            with open(yml_path, 'w') as f:
+                yaml.dump({'txid': 0, 'root': root}, f)
+        del root
+
+        img_load = timed(FsImage.load, img_path)
+
+        print('entries: %d' % entries)
+        print('%-8s %14s %12s' % ('format', 'bytes', 'load (s)'))
+        if with_yaml:
+            yml_load = timed(FsImage.load_yaml, yml_path)
+            print('%-8s %14d %12.2f' % ('yaml', os.path.getsize(yml_path), yml_load))
+        print('%-8s %14d %12.2f' % ('binary', os.path.getsize(img_path), img_load))
+        if with_yaml:
+            print('speedup: %.1fx' % (yml_load / img_load))
+        else:
+            print('yaml skipped above %d entries, pass --yaml to time it' % YAML_LIMIT)
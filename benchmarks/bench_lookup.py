@@ -0,0 +1,40 @@
+#!/usr/bin/env python3.11
+# Lookups per second against directory fan-out.
+#
+#   python3 benchmarks/bench_lookup.py [lookups]
+import random
+import sys
+import time
+from os.path import dirname, abspath
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+from ns.name_server import NameNode
+
+FAN_OUTS = [10, 1000, 10000, 100000, 200000]
+
+
+def build(fan_out):
+    ns = NameNode(dump_on=False)
+    directory = ns.root.create_dir('/bench')
+    for i in range(fan_out):
+        ns.root.create_file('/bench/file_%d' % i)
+    return ns, directory
+
+
+def rate(fn, paths):
+    start = time.perf_counter()
+    for p in paths:
+        fn(p)
+    return len(paths) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('%10s %18s %18s %18s' % ('fan-out', 'find_path/s', 'get_file_info/s', 'cache hit rate'))
+    for fan_out in FAN_OUTS:
+        ns, _ = build(fan_out)
+        paths = ['/bench/file_%d' % random.randrange(fan_out) for _ in range(lookups)]
+        tree = rate(ns.root.find_path, paths)
+        info = rate(ns.get_file_info, paths)
+        total = ns.path_cache.hits + ns.path_cache.misses
+        print('%10d %18.0f %18.0f %17.1f%%' % (fan_out, tree, info, 100.0 * ns.path_cache.hits / total))
@@ -1,11 +1,21 @@
 #!/usr/bin/env python3.11
 import os
 import errno
-from xmlrpc.client import ServerProxy
+from xmlrpc.client import ServerProxy, Binary
+from urllib.parse import urlsplit
 import ssl
 import socket
+import struct
+import zlib
 
 import sys
+from os.path import dirname, abspath
+sys.path.append(dirname(dirname(abspath(__file__))))
+try:
+    # only erasure-coded files need NumPy
+    from utils.erasure import ReedSolomon
+except ImportError:
+    ReedSolomon = None
 # from os.path import dirname
 # sys.path.append(dirname(dirname(__file__)))
 # from utils.enums import Status
@@ -41,35 +51,171 @@ class Status:
         return message
 
 
+class MountTable:
+    """Path prefix -> address of the NameNode that owns that subtree.
+
+    Written as '/logs=http://ns2:8888,/warehouse=http://ns3:8888' (the
+    YAD_MOUNTS variable). The longest matching prefix wins and '/' falls
+    back to the default NameNode.
+    """
+
+    def __init__(self, default_addr, spec=''):
+        self.mounts = {'/': default_addr}
+        for entry in spec.split(','):
+            if '=' not in entry:
+                continue
+            prefix, addr = entry.split('=', 1)
+            self.mounts['/' + prefix.strip().strip('/')] = addr.strip()
+
+    def resolve(self, path):
+        path = '/' + path.strip('/')
+        while True:
+            if path in self.mounts:
+                return path, self.mounts[path]
+            path = path[:path.rfind('/')] or '/'
+
+    def mounts_under(self, path):
+        """Mount points that are direct children of path."""
+        path = '/' + path.strip('/')
+        base = path.rstrip('/')
+        return [m for m in self.mounts if m != '/' and m[:m.rfind('/')] == base]
+
+
 class Client:
-    def __init__(self, ns_addr=None):
+    # chunk servers move chunk bytes on their RPC port + DATA_PORT_OFFSET,
+    # see DataTransferHandler in chunk_server.py
+    DATA_PORT_OFFSET = 1
+    PUT_MAGIC = b'YADP'
+    GET_MAGIC = b'YADG'
+    PUT_HEADER = struct.Struct('<4sHQ')
+    GET_HEADER = struct.Struct('<4sHQQ')
+    REPLY = struct.Struct('<BQQI')
+    CRC = struct.Struct('<I')
+    # bytes per chunk of an uploaded file
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, ns_addr=None, mounts=None):
         self.chunk_servers = []
         if ns_addr is not None:
             os.environ['YAD_NS'] = ns_addr
         elif not os.getenv('YAD_NS'):
             os.environ['YAD_NS'] = 'http://localhost:8888'
 
-        self.ns = ServerProxy(os.environ['YAD_NS'])
+        if mounts is None:
+            mounts = os.getenv('YAD_MOUNTS', '')
+        self.mount_table = MountTable(os.environ['YAD_NS'], mounts)
+        self.proxies = {}
+        self.ns = self._proxy(os.environ['YAD_NS'])
 
-    def list(self, path):
-        return self.ns.list(path)
+    def _proxy(self, addr):
+        if addr not in self.proxies:
+            self.proxies[addr] = ServerProxy(addr)
+        return self.proxies[addr]
+
+    def _ns_for(self, path):
+        return self._proxy(self.mount_table.resolve(path)[1])
 
-    def list_dir(self, dir_path):
-        return self.ns.list_directory(dir_path)
+    def list(self, path):
+        return self._ns_for(path).list(path)
+
+    def list_dir(self, dir_path, start_after='', limit=0, include_chunks=True):
+        result = self._ns_for(dir_path).list_directory(dir_path, start_after, limit, include_chunks)
+        if result['status'] != Status.ok:
+            return result
+
+        # mount points show up as directories of the parent namespace
+        owner = self.mount_table.resolve(dir_path)[1]
+        for mount in self.mount_table.mounts_under(dir_path):
+            name = mount[mount.rfind('/') + 1:]
+            if name <= start_after or (result['next'] and name > result['next']):
+                continue
+            if self.mount_table.mounts[mount] == owner:
+                continue
+            info = self._ns_for(mount).get_file_info(mount)
+            if info['status'] != Status.ok:
+                info = {'status': Status.ok, 'type': NodeType.directory, 'path': mount,
+                        'size': 0, 'date': 0, 'chunks': {}}
+            result['items'][name] = info
+        return result
+
+    def iter_dir(self, dir_path, page_size=1000, include_chunks=False):
+        """Yield (status, name, info) one page at a time."""
+        start_after = ''
+        while True:
+            page = self.list_dir(dir_path, start_after, page_size, include_chunks)
+            if page['status'] != Status.ok:
+                yield page['status'], None, None
+                return
+            for name, info in page['items'].items():
+                yield Status.ok, name, info
+            start_after = page['next']
+            if not start_after:
+                return
     
+    def search(self, query, page_size=1000):
+        """Yield (status, info) for every path matching query, page by page."""
+        query = dict(query, limit=page_size, start_after='')
+        ns = self._ns_for(query.get('pattern') or query.get('prefix', '/'))
+        while True:
+            page = ns.search_files(query)
+            if page['status'] != Status.ok:
+                yield page['status'], None
+                return
+            for info in page['items']:
+                yield Status.ok, info
+            if not page['next']:
+                return
+            query['start_after'] = page['next']
+
     def list_file(self, file_path):
-        return self.ns.list_file(file_path)
+        return self._ns_for(file_path).list_file(file_path)
 
     def create_dir(self, path):
-        return self.ns.make_directory(path)
+        return self._ns_for(path).make_directory(path)
     
 
 
+    def setrep(self, path, replication):
+        return self._ns_for(path).setrep(path, replication)
+
+    def _all_ns(self):
+        return [self._proxy(addr) for addr in sorted(set(self.mount_table.mounts.values()))]
+
+    def decommission(self, cs_addr):
+        """Drain cs_addr on every name server whose chunks it may hold."""
+        results = [ns.decommission(cs_addr) for ns in self._all_ns()]
+        if any(r['status'] == Status.ok for r in results):
+            return {'status': Status.ok}
+        return results[0]
+
+    def recommission(self, cs_addr):
+        results = [ns.recommission(cs_addr) for ns in self._all_ns()]
+        if any(r['status'] == Status.ok for r in results):
+            return {'status': Status.ok}
+        return results[0]
+
+    def decommission_status(self, cs_addr=''):
+        """Progress summed over the name servers; a chunk server is only
+        decommissioned once every one of them says so."""
+        nodes = {}
+        for ns in self._all_ns():
+            res = ns.decommission_status(cs_addr)
+            for addr, node in res.get('nodes', {}).items():
+                total = nodes.setdefault(addr, dict(node, chunks=0, remaining=0))
+                total['chunks'] += node['chunks']
+                total['remaining'] += node['remaining']
+                total['started'] = min(total['started'], node['started'])
+                if node['state'] != 'decommissioned':
+                    total['state'] = node['state']
+        if cs_addr and not nodes:
+            return {'status': Status.not_found}
+        return {'status': Status.ok, 'nodes': nodes}
+
     def delete_dir(self, path):
-        return self.ns.delete_dir(path)
+        return self._ns_for(path).delete_dir(path)
     
     def delete_file(self, path):
-        return self.ns.delete_file(path)
+        return self._ns_for(path).delete_file(path)
 
     def create_file(self, path, remote_path):
         fn = path.split("/")[-1]
@@ -78,29 +224,113 @@ class Client:
         if not os.path.isfile(path):
             return {'status': Status.not_found}
 
-        with open(path, 'r') as fr:
+        with open(path, 'rb') as fr:
             data = fr.read()
 
         return self._save_file_to_dfs(data, remote_filepath)
     
     
     def _save_file_to_dfs(self, content, remote_filepath):
+        if isinstance(content, str):
+            content = content.encode()
         r = self._get_cs(remote_filepath)
         if not r['status'] == Status.ok:
             return r
-        cs_addr = r['cs']
-        cs = ServerProxy(cs_addr)
 
-        chunks = self.split_file(content)
+        data = self._upload_chunks(content, remote_filepath, r['cs'])
+        return self._ns_for(remote_filepath).create_file(data)
+
+    def _upload_chunks(self, content, remote_filepath, cs_addr):
+        chunks = self.split_file(content, self.CHUNK_SIZE)
         data = {}
         data['path'] = remote_filepath
         data['size'] = len(content)
         data['chunks'] = {}
+        # kept by the name server so pread can map offsets to chunks
+        data['sizes'] = {}
         for count, chunk in enumerate(chunks):
-            cs.upload_chunk(remote_filepath + '_{0}'.format(str(count)), chunk)
+            self._write_chunk(cs_addr, remote_filepath + '_{0}'.format(str(count)), chunk)
             data['chunks'][remote_filepath + '_' + str(count)] = cs_addr
+            data['sizes'][remote_filepath + '_' + str(count)] = len(chunk)
+        return data
 
-        return self.ns.create_file(data)
+    def _write_chunk(self, addr, chunk_id, data):
+        """Store bytes (or any buffer) as a chunk through addr's data port,
+        or over XML-RPC when the chunk server has none."""
+        url = urlsplit(addr)
+        try:
+            sock = socket.create_connection((url.hostname, url.port + self.DATA_PORT_OFFSET), timeout=60)
+        except ConnectionRefusedError:
+            self._proxy(addr).upload_chunk(chunk_id, Binary(bytes(data)))
+            return
+        with sock:
+            name = chunk_id.encode()
+            view = memoryview(data).cast('B')
+            sock.sendall(self.PUT_HEADER.pack(self.PUT_MAGIC, len(name), len(view)) + name)
+            sock.sendall(view)
+            sock.sendall(self.CRC.pack(zlib.crc32(view)))
+            reply = sock.recv(1)
+        if reply != b'\x00':
+            raise IOError('Chunk %s not stored on %s (reply %r)' % (chunk_id, addr, reply))
+
+    def _batch(self, method, items, path_of=None, *args):
+        """Call a batch RPC once per owning name server and return the
+        per-item results in input order."""
+        groups = {}
+        for i, item in enumerate(items):
+            path = item if path_of is None else path_of(item)
+            groups.setdefault(self.mount_table.resolve(path)[1], []).append(i)
+
+        results = [None] * len(items)
+        for addr, indices in groups.items():
+            reply = getattr(self._proxy(addr), method)([items[i] for i in indices], *args)
+            for i, r in zip(indices, reply['items']):
+                results[i] = r
+        return results
+
+    def get_file_info_many(self, paths, include_chunks=True):
+        return self._batch('get_file_info_many', paths, None, include_chunks)
+
+    def create_dirs(self, paths):
+        return self._batch('make_directories', paths)
+
+    def delete_many(self, paths):
+        return self._batch('delete_many', paths)
+
+    def upload_files(self, files, batch_size=1000):
+        """Upload (local_path, remote_filepath) pairs; placement and file
+        creation go to the name servers batch_size files at a time."""
+        results = []
+        for start in range(0, len(files), batch_size):
+            batch = files[start:start + batch_size]
+            statuses = [None] * len(batch)
+            placements = self._batch('get_cs_many', [remote for _, remote in batch])
+
+            created = []
+            datas = []
+            for i, ((local_path, remote_filepath), placement) in enumerate(zip(batch, placements)):
+                if placement['status'] != Status.ok:
+                    statuses[i] = {'status': placement['status']}
+                    continue
+                with open(local_path, 'rb') as fr:
+                    content = fr.read()
+                datas.append(self._upload_chunks(content, remote_filepath, placement['cs']))
+                created.append(i)
+
+            for i, r in zip(created, self._batch('create_files', datas, lambda d: d['path'])):
+                statuses[i] = r
+            results.extend(statuses)
+        return results
+
+    def upload_dir(self, local_dir, remote_path):
+        base = os.path.basename(os.path.normpath(local_dir))
+        files = []
+        for dirpath, dirnames, filenames in os.walk(local_dir):
+            rel = os.path.relpath(dirpath, local_dir)
+            for fn in filenames:
+                remote_dir = os.path.join(remote_path, base) if rel == '.' else os.path.join(remote_path, base, rel)
+                files.append((os.path.join(dirpath, fn), os.path.join(remote_dir, fn)))
+        return self.upload_files(files)
     
     def upload_file(self, path, remote_path):
         fn = path.split("/")[-1]
@@ -109,16 +339,16 @@ class Client:
         if not os.path.isfile(path):
             return {'status': Status.not_found}
 
-        with open(path, 'r') as fr:
+        with open(path, 'rb') as fr:
             data = fr.read()
 
         return self._save_file_to_dfs(data, remote_filepath)
 
     def delete(self, path):
-        return self.ns.delete(path)
+        return self._ns_for(path).delete(path)
     
     def delete_file(self, path):
-        return self.ns.delete_file(path)
+        return self._ns_for(path).delete_file(path)
 
     def download_file(self, path, dst_path):
         result, content = self.get_file_content(path)
@@ -128,7 +358,7 @@ class Client:
         fn = path.split("/")[-1]
         self.make_sure_path_exists(dst_path)
         file_path = os.path.join(dst_path, fn)
-        with open(file_path, "w") as f:
+        with open(file_path, "wb") as f:
             f.write(content)
             return {'status': Status.ok}
         
@@ -140,35 +370,205 @@ class Client:
         fn = path.split("/")[-1]
         self.make_sure_path_exists(dst_path)
         file_path = os.path.join(dst_path, fn)
-        with open(file_path, "w") as f:
+        with open(file_path, "wb") as f:
             f.write(content)
             return {'status': Status.ok}
 
     def get_file_content(self, path):
-        info = self.ns.get_file_info(path)
+        info = self._ns_for(path).get_file_info(path)
         if info['status'] != Status.ok:
             return info['status'], None
+        if 'ec' in info:
+            return Status.ok, self._read_ec(info)
 
-        chunks = info['chunks']
-        content = ""
         data = {}
-        for chunk, addr in chunks.items():
-            cs = ServerProxy(addr)
-            chunk_data = cs.get_chunk(chunk)
-            index = int(chunk.split("_")[-1])
-            data[index] = chunk_data
+        for chunk, addr in info['chunks'].items():
+            data[int(chunk.split("_")[-1])] = self._read_replica(path, chunk, addr)
+        return Status.ok, b''.join(data[i] for i in range(len(data)))
 
-        i = 0
-        while i < len(data):
-            content += data[i]
-            i += 1
+    def pread(self, path, offset, length):
+        """Up to length bytes of a file from offset, fetching only the byte
+        ranges of the chunks that cover them."""
+        info = self._ns_for(path).get_file_info(path)
+        if info['status'] != Status.ok:
+            return info['status'], None
+        end = min(offset + length, info['size'])
+        if end <= offset:
+            return Status.ok, b''
+        if 'ec' in info:
+            return Status.ok, self._pread_ec(info, offset, end)
+
+        sizes = info.get('sizes', {})
+        chunks = sorted(info['chunks'].items(), key=lambda c: int(c[0].split("_")[-1]))
+        if any(chunk not in sizes for chunk, _ in chunks):
+            # written before the name server kept chunk sizes
+            status, data = self.get_file_content(path)
+            return status, data[offset:end]
+        parts = []
+        pos = 0
+        for chunk, addr in chunks:
+            size = sizes[chunk]
+            if pos < end and pos + size > offset:
+                lo = max(offset, pos) - pos
+                parts.append(self._read_replica(path, chunk, addr, lo, min(end, pos + size) - pos - lo))
+            pos += size
+        return Status.ok, b''.join(parts)
+
+    def _read_replica(self, path, chunk, addr, offset=0, length=0):
+        try:
+            return self._read_chunk(addr, chunk, offset, length)
+        except Exception as e:
+            # a corrupt copy is dropped once reported; ask for another
+            print('Chunk', chunk, 'unreadable on', addr, ':', e)
+            retry = self._ns_for(path).get_file_info(path)
+            other = retry.get('chunks', {}).get(chunk)
+            if not other or other == addr:
+                raise
+            return self._read_chunk(other, chunk, offset, length)
 
-        return Status.ok, content
+    def _read_chunk(self, addr, chunk_id, offset=0, length=0):
+        """Bytes of a chunk from addr's data port, or over XML-RPC when the
+        chunk server has none. length 0 reads to the end."""
+        url = urlsplit(addr)
+        try:
+            sock = socket.create_connection((url.hostname, url.port + self.DATA_PORT_OFFSET), timeout=60)
+        except ConnectionRefusedError:
+            return self._proxy(addr).read_chunk(chunk_id, offset, length).data
+        with sock:
+            name = chunk_id.encode()
+            sock.sendall(self.GET_HEADER.pack(self.GET_MAGIC, len(name), offset, length) + name)
+            reply = self._recv_exactly(sock, self.REPLY.size)
+            status, start, size, block_size = self.REPLY.unpack(reply)
+            if status != 0:
+                raise IOError('Chunk %s unreadable on %s (status %d)' % (chunk_id, addr, status))
+            # the reply covers whole checksum blocks around the range
+            data = memoryview(self._recv_exactly(sock, size))
+            count = -(-size // block_size)
+            crcs = struct.unpack('<%dI' % count, self._recv_exactly(sock, 4 * count))
+        for i, crc in enumerate(crcs):
+            if zlib.crc32(data[i * block_size:(i + 1) * block_size]) != crc:
+                try:
+                    self._ns_for(chunk_id).report_bad_chunks(addr, [chunk_id])
+                except Exception:
+                    pass
+                raise IOError('Chunk %s failed its checksum on %s' % (chunk_id, addr))
+        skip = offset - start
+        return bytes(data[skip:skip + length] if length else data[skip:])
 
+    @staticmethod
+    def _recv_exactly(sock, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        got = 0
+        while got < size:
+            n = sock.recv_into(view[got:])
+            if n == 0:
+                raise IOError('Connection closed after %d of %d bytes' % (got, size))
+            got += n
+        return buf
+
+
+
+    def _read_ec(self, info):
+        """Bytes of an erasure-coded file, decoding around missing shards."""
+        if ReedSolomon is None:
+            raise RuntimeError('Reading erasure-coded files needs NumPy')
+        k, m, shard_size = info['ec']
+        rs = ReedSolomon(k, m)
+        groups = self._ec_groups(info)
+        content = bytearray()
+        for group in sorted(groups):
+            content += self._decode_ec_group(rs, groups[group])
+        return bytes(content[:info['size']])
 
+    @staticmethod
+    def _ec_groups(info):
+        """{group: {shard index: (chunk id, chunk server)}} of an EC file."""
+        groups = {}
+        for chunk_id, addr in info['chunks'].items():
+            base, index = chunk_id.rsplit('_', 1)
+            group = int(base.rsplit('_ec', 1)[1])
+            groups.setdefault(group, {})[int(index)] = (chunk_id, addr)
+        return groups
+
+    def _decode_ec_group(self, rs, shards_of):
+        shards = [None] * (rs.k + rs.m)
+        found = 0
+        # data shards first: with all k present no decoding is needed
+        for i in range(rs.k + rs.m):
+            if found == rs.k:
+                break
+            chunk_id, addr = shards_of.get(i, (None, ''))
+            if not addr:
+                continue
+            try:
+                shards[i] = self._read_chunk(addr, chunk_id)
+                found += 1
+            except Exception as e:
+                print('Shard', chunk_id, 'unreadable on', addr, ':', e)
+        return b''.join(shard.tobytes() for shard in rs.decode(shards))
+
+    def _pread_ec(self, info, offset, end):
+        """Bytes [offset, end) of an erasure-coded file. Ranges are read from
+        the data shards holding them; a group with an unreadable one is
+        decoded whole."""
+        k, m, shard_size = info['ec']
+        groups = self._ec_groups(info)
+        parts = []
+        for group in range(offset // (k * shard_size), -(-end // (k * shard_size))):
+            base = group * k * shard_size
+            # ec_convert cuts a short last group into shards of its own size
+            shard = min(shard_size, -(-(info['size'] - base) // k)) or 1
+            got = []
+            try:
+                for i in range(k):
+                    lo = max(offset, base + i * shard)
+                    hi = min(end, base + (i + 1) * shard)
+                    if lo < hi:
+                        chunk_id, addr = groups[group][i]
+                        got.append(self._read_chunk(addr, chunk_id, lo - base - i * shard, hi - lo))
+            except Exception as e:
+                print('EC group', group, 'needs decoding:', e)
+                if ReedSolomon is None:
+                    raise RuntimeError('Reading erasure-coded files needs NumPy')
+                data = self._decode_ec_group(ReedSolomon(k, m), groups[group])
+                got = [data[max(offset, base) - base:min(end, base + k * shard_size) - base]]
+            parts.extend(got)
+        return b''.join(parts)
+
+    def ec_convert(self, path, k=6, m=3, shard_size=1 << 20):
+        """Rewrite a replicated file as RS(k, m) erasure-coded shard groups."""
+        if ReedSolomon is None:
+            raise RuntimeError('Erasure coding needs NumPy')
+        ns = self._ns_for(path)
+        status, data = self.get_file_content(path)
+        if status != Status.ok:
+            return {'status': status}
+        shard_size = max(1, min(shard_size, -(-len(data) // k)))
+        group_size = k * shard_size
+
+        r = ns.get_cs_group(k + m)
+        if r['status'] != Status.ok:
+            return r
+        servers = r['cs']
+
+        rs = ReedSolomon(k, m)
+        chunks = {}
+        for group, start in enumerate(range(0, max(len(data), 1), group_size)):
+            # the last group may be short; it is cut into k shards of
+            # ceil(len / k) bytes, only the last of them zero-padded
+            shards = rs.split(data[start:start + group_size])
+            for i, shard in enumerate(shards + rs.encode(shards)):
+                # rotate so parity doesn't always land on the same servers
+                addr = servers[(i + group) % len(servers)]
+                chunk_id = '%s_ec%d_%d' % (path, group, i)
+                self._write_chunk(addr, chunk_id, shard)
+                chunks[chunk_id] = addr
+
+        return ns.convert_to_ec({'path': path, 'size': len(data), 'ec': [k, m, shard_size], 'chunks': chunks})
 
     def get_file_info(self, path):
-        info = self.ns.get_file_info(path)
+        info = self._ns_for(path).get_file_info(path)
         if info['status'] != Status.ok:
             return info['status'], None
         
@@ -177,19 +577,17 @@ class Client:
 
 
     def get_chunk(self, path, chunk_id):
-        info = self.ns.get_file_info(path)
+        info = self._ns_for(path).get_file_info(path)
         if info['status'] != Status.ok:
             return info['status'], None
         
         chunks = info['chunks']
         for chunk, addr in chunks.items():
             if int(chunk.split("_")[-1]) == chunk_id:
-                cs = ServerProxy(addr)
-                chunk_data = cs.get_chunk(chunk)
-                return Status.ok, chunk_data
+                return Status.ok, self._read_chunk(addr, chunk)
     
     def get_chunk_info(self, path, chunk_id):
-        info = self.ns.get_file_info(path)
+        info = self._ns_for(path).get_file_info(path)
         if info['status'] != Status.ok:
             return info['status'], None
         
@@ -199,13 +597,13 @@ class Client:
                 return Status.ok, chunk
 
     def path_status(self, path):
-        return self.ns.get_file_info(path)
+        return self._ns_for(path).get_file_info(path)
     
     def get_file_info_(self, path):
-        return self.ns.get_file_info(path)
+        return self._ns_for(path).get_file_info(path)
 
     def _get_cs(self, path):
-        result = self.ns.get_cs(path)
+        result = self._ns_for(path).get_cs(path)
         print(result)
         if 'cs' not in result:
             return {'status': Status.error, 'cs': None}
@@ -218,11 +616,10 @@ class Client:
         r_index = path.rindex('_')
         f_path = path[:r_index]
 
-        info = self.ns.get_file_info(f_path)
+        info = self._ns_for(f_path).get_file_info(f_path)
         for chunk, addr in info['chunks'].items():
             if chunk == path:
-                cs = ServerProxy(addr)
-                return {'status': Status.ok, 'data': cs.get_chunk(chunk)}
+                return {'status': Status.ok, 'data': self._read_chunk(addr, chunk)}
 
         return {'status': Status.not_found}
 
@@ -230,7 +627,7 @@ class Client:
         r_index = path.rindex('_')
         f_path = path[:r_index]
 
-        info = self.ns.get_file_info(f_path)
+        info = self._ns_for(f_path).get_file_info(f_path)
         for chunk, addr in info['chunks'].items():
             if chunk == path:
                 return {'status': Status.ok, 'data': chunk}
@@ -240,7 +637,7 @@ class Client:
     def download_to(self, v_path, l_path):
         st, data = self.get_file_content(v_path)
         os.makedirs(os.path.dirname(l_path), exist_ok=True)
-        with open(l_path, "w") as f:
+        with open(l_path, "wb") as f:
             f.write(data)
 
         return {'status': Status.ok}
@@ -253,7 +650,7 @@ class Client:
     def download_to_(self, v_path, l_path):
         st, data = self.get_file_content(v_path)
         os.makedirs(os.path.dirname(l_path), exist_ok=True)
-        with open(l_path, "w") as f:
+        with open(l_path, "wb") as f:
             f.write(data)
 
         return {'status': Status.ok}
@@ -265,20 +662,10 @@ class Client:
     
 
     @staticmethod
-    def split_file(data, chunksize=1024):
-        chunks = []
-        while len(data) >= chunksize:
-            i = chunksize
-            while not data[i]==' ':
-                if i == 0:
-                    i = chunksize
-                    break
-                else:
-                    i -= 1
-            chunks.append(data[:i])
-            data = data[i:]
-        chunks.append(data)
-        return chunks
+    def split_file(data, chunksize=CHUNK_SIZE):
+        """Cut bytes into chunksize pieces; an empty file is one empty chunk."""
+        view = memoryview(data)
+        return [view[i:i + chunksize] for i in range(0, len(data), chunksize)] or [view]
 
     
     @staticmethod
@@ -286,7 +673,7 @@ class Client:
         if os.path.isfile(filename):
             return Status.already_exists
 
-        with open(filename, 'x') as fw:
+        with open(filename, 'xb') as fw:
             for chunk in chunks:
                 fw.write(chunk)
 
@@ -1,12 +1,26 @@
 #!/usr/bin/env python3.11
 from xmlrpc.server import SimpleXMLRPCServer
-from xmlrpc.client import ServerProxy
+from socketserver import ThreadingMixIn, ThreadingTCPServer, StreamRequestHandler
+from urllib.parse import urlsplit
+from xmlrpc.client import ServerProxy, Binary
 import sys
 import os
-import errno
 import time
 import socket
+import shutil
+import struct
+import zlib
+import threading
 import _thread
+from collections import OrderedDict
+from os.path import dirname, abspath
+sys.path.append(dirname(dirname(abspath(__file__))))
+from utils.chunk_store import ChunkStore
+try:
+    # erasure-coded rebuilds need NumPy; plain replicas work without it
+    from utils.erasure import ReedSolomon
+except ImportError:
+    ReedSolomon = None
 # from os.path import dirname
 # sys.path.append(dirname(dirname(__file__)))
 # from utils.enums import Status
@@ -43,13 +57,287 @@ class Status:
         return message
 
 
+class ThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class DataServer(ThreadingTCPServer):
+    daemon_threads = True
+    # reads leave many sockets in TIME_WAIT; don't let them block a restart
+    allow_reuse_address = True
+
+
+class ChecksumError(IOError):
+    pass
+
+
+class ChunkCache:
+    """Byte-budgeted read cache of whole chunks, in the spirit of 2Q.
+
+    A chunk is only cached on its second read while its key is still in
+    the ghost list of recent misses, so one-off scans keep going through
+    the page cache instead of flushing hot chunks. Cached chunks are
+    evicted least recently used first, except pinned ones. A miss that is
+    worth caching gets a token from lookup(); put() drops the data if the
+    chunk was invalidated by a write or delete since that token was issued.
+    """
+
+    def __init__(self, capacity, ghosts=4096):
+        self.capacity = capacity
+        self.ghost_limit = ghosts
+        self.size = 0
+        self.entries = OrderedDict()
+        self.ghosts = OrderedDict()
+        self.pinned = set()
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """(data, None) on a hit, (None, token or None) on a miss."""
+        if self.capacity <= 0:
+            return None, None
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return data, None
+            self.misses += 1
+            if key not in self.pinned and self.ghosts.pop(key, None) is None:
+                self.ghosts[key] = True
+                if len(self.ghosts) > self.ghost_limit:
+                    self.ghosts.popitem(last=False)
+                return None, None
+            token = self.loading[key] = object()
+            return None, token
+
+    def put(self, key, data, token):
+        with self.lock:
+            if self.loading.get(key) is not token:
+                return False
+            del self.loading[key]
+            if key in self.entries:
+                return True
+            self.entries[key] = data
+            self.size += len(data)
+            self._evict()
+            return key in self.entries
+
+    def _evict(self):
+        if self.size <= self.capacity:
+            return
+        for key in list(self.entries):
+            if key in self.pinned:
+                continue
+            self.size -= len(self.entries.pop(key))
+            self.evictions += 1
+            if self.size <= self.capacity:
+                return
+
+    def invalidate(self, key):
+        with self.lock:
+            self.loading.pop(key, None)
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.size -= len(data)
+
+    def pin(self, key):
+        with self.lock:
+            self.pinned.add(key)
+
+    def unpin(self, key):
+        with self.lock:
+            self.pinned.discard(key)
+            self._evict()
+
+    def stats(self):
+        with self.lock:
+            # byte counts as floats: XML-RPC ints stop at 2**31
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'chunks': len(self.entries), 'bytes': float(self.size),
+                    'capacity': float(self.capacity), 'pinned': len(self.pinned)}
+
+
+class DataTransferHandler(StreamRequestHandler):
+    """Moves one chunk per connection on the data port.
+
+    PUT: PUT_HEADER (magic, chunk id length, size), the chunk id, size bytes
+    of data and the CRC-32 of the data. The data is received a checksum
+    block at a time and appended to the chunk store, with its block
+    checksums, only if the CRC matches; the reply is one status byte. A
+    size over the server's max_chunk_bytes is refused before anything is
+    allocated for it.
+
+    GET: GET_HEADER (magic, chunk id length, offset, length) and the chunk
+    id; length 0 reads to the end. The range is widened to whole checksum
+    blocks: the reply is REPLY (status, start offset, size, block size),
+    size bytes sent from the segment file with os.sendfile and the stored
+    CRC-32 of each block, which the reader verifies.
+    """
+    MAGIC = b'YADP'
+    GET_MAGIC = b'YADG'
+    PUT_HEADER = struct.Struct('<4sHQ')
+    GET_HEADER = struct.Struct('<4sHQQ')
+    REPLY = struct.Struct('<BQQI')
+    CRC = struct.Struct('<I')
+    OK, BAD_CHECKSUM, FAILED, NOT_FOUND, CORRUPT = 0, 1, 2, 3, 4
+
+    def handle(self):
+        magic = self.rfile.read(len(self.MAGIC))
+        if magic == self.MAGIC:
+            self._put(magic)
+        elif magic == self.GET_MAGIC:
+            self._get(magic)
+
+    def _get(self, magic):
+        cs = self.server.cs
+        header = magic + self.rfile.read(self.GET_HEADER.size - len(magic))
+        if len(header) < self.GET_HEADER.size:
+            return
+        _, id_len, offset, length = self.GET_HEADER.unpack(header)
+        chunk_path = self.rfile.read(id_len).decode()
+        try:
+            data = cs.read_cached(chunk_path)
+            if data is None:
+                seg, base, chunk_size, block_size, crcs = cs.store.locate(chunk_path)
+            else:
+                chunk_size = len(data)
+                block_size, crcs = cs.store.checksums(chunk_path)
+        except FileNotFoundError:
+            self.wfile.write(self.REPLY.pack(self.NOT_FOUND, 0, 0, 0))
+            return
+        except ChecksumError:
+            self.wfile.write(self.REPLY.pack(self.CORRUPT, 0, 0, 0))
+            return
+
+        offset = min(offset, chunk_size)
+        end = chunk_size if not length else min(chunk_size, offset + length)
+        start = offset - offset % block_size
+        end = min(chunk_size, -(-end // block_size) * block_size)
+        first = start // block_size
+        blocks = crcs[first:first + -(-(end - start) // block_size)]
+        self.wfile.write(self.REPLY.pack(self.OK, start, end - start, block_size))
+        if data is not None:
+            self.wfile.write(memoryview(data)[start:end])
+        else:
+            sock = self.connection.fileno()
+            sent = 0
+            while sent < end - start:
+                n = os.sendfile(sock, seg.fd, base + start + sent, end - start - sent)
+                if n == 0:
+                    break
+                sent += n
+        self.wfile.write(struct.pack('<%dI' % len(blocks), *blocks))
+
+    def _put(self, magic):
+        cs = self.server.cs
+        header = magic + self.rfile.read(self.PUT_HEADER.size - len(magic))
+        if len(header) < self.PUT_HEADER.size:
+            return
+        _, id_len, size = self.PUT_HEADER.unpack(header)
+        chunk_path = self.rfile.read(id_len).decode()
+        if size > cs.max_chunk_bytes:
+            print('Refused', chunk_path, ':', size, 'bytes is over the', cs.max_chunk_bytes, 'byte limit')
+            self.wfile.write(bytes([self.FAILED]))
+            return
+        try:
+            # buffered whole: a record only goes into the log once its CRC matches
+            data = bytearray(size)
+            view = memoryview(data)
+            crc = 0
+            blocks = []
+            for pos in range(0, size, cs.BLOCK_SIZE):
+                block = view[pos:pos + cs.BLOCK_SIZE]
+                # whole blocks: the buffered reader only returns short at EOF
+                if self.rfile.readinto(block) != len(block):
+                    raise IOError('connection closed with %d bytes left' % (size - pos))
+                crc = zlib.crc32(block, crc)
+                blocks.append(zlib.crc32(block))
+            (expected,) = self.CRC.unpack(self.rfile.read(self.CRC.size))
+            if expected != crc:
+                print('Checksum mismatch receiving', chunk_path)
+                self.wfile.write(bytes([self.BAD_CHECKSUM]))
+                return
+            mtime = cs.store.put(chunk_path, data, cs.BLOCK_SIZE, blocks, sync=True)
+            cs.cache.invalidate(cs.store.key(chunk_path))
+            cs._record(chunk_path, mtime)
+            print('Received', chunk_path, size, 'bytes')
+            self.wfile.write(bytes([self.OK]))
+        except Exception as e:
+            print('Receiving', chunk_path, 'failed:', e)
+            self.wfile.write(bytes([self.FAILED]))
+
+
 class ChunkServer:
-    def __init__(self, addr, ns_addr):
+    read_methods = ('get_chunk', 'get_chunk_bytes', 'read_chunk', 'replicate_chunk')
+    write_methods = ('upload_chunk', 'delete_chunk', 'delete_chunks', 'reconstruct_chunk')
+
+    # chunk servers listen for transfers on their RPC port + DATA_PORT_OFFSET
+    DATA_PORT_OFFSET = 1
+    # chunk data is checksummed in BLOCK_SIZE blocks, the CRCs stored with the
+    # chunk. Chunks kept one file each before the chunk store had them in a
+    # sidecar file: META_HEADER (magic, block size), then a CRC-32 each
+    BLOCK_SIZE = 1 << 16
+    META_MAGIC = b'YADM'
+    META_HEADER = struct.Struct('<4sI')
+
+    def __init__(self, addr, ns_addr, mounts='', rack='', max_workers=8, cache_bytes=64 << 20,
+                 scrub_rate=4 << 20, scrub_period=7 * 24 * 3600, segment_bytes=256 << 20,
+                 compact_interval=600, max_chunk_bytes=64 << 20):
         self.ns = ServerProxy(ns_addr)
         self.addr = addr
         self.ns_addr = ns_addr
+        # with a federated namespace every name server in the mount table
+        # ('/logs=http://ns2:8888,...') gets our heartbeats, each with the
+        # block report for the chunks under its mounts
+        self.mounts = {'/': ns_addr}
+        for entry in mounts.split(','):
+            if '=' in entry:
+                prefix, mount_addr = entry.split('=', 1)
+                self.mounts['/' + prefix.strip().strip('/')] = mount_addr.strip()
+        self.ns_addrs = [ns_addr]
+        for mount_addr in self.mounts.values():
+            if mount_addr not in self.ns_addrs:
+                self.ns_addrs.append(mount_addr)
         self.local_fs_root = "/tmp/yadfs/chunks"
+        # chunks are appended to segment files of up to segment_bytes in
+        # local_fs_root/.yadstore; every compact_interval seconds segments
+        # that are mostly deleted chunks are rewritten
+        self.segment_bytes = segment_bytes
+        # largest chunk the data port takes; the size comes from the sender
+        self.max_chunk_bytes = max_chunk_bytes
+        self.compact_interval = compact_interval
+        self.store = None
         self.hb_timeout = 0.5  # heartbeat timeout in seconds
+        self.full_report_interval = 3600
+        # block report state per name server: chunks added (id -> mtime) and
+        # deleted since the last heartbeat it acknowledged, and whether it
+        # gets a full report next
+        self.report_lock = threading.Lock()
+        self.added = {a: {} for a in self.ns_addrs}
+        self.deleted = {a: set() for a in self.ns_addrs}
+        self.full_due = {a: 0 for a in self.ns_addrs}
+        # load sent with heartbeats so the name server can place chunks
+        self.rack = rack
+        self.workers = threading.BoundedSemaphore(max_workers)
+        self.stats_lock = threading.Lock()
+        self.active_reads = 0
+        self.active_writes = 0
+        self.waiting = 0
+        self.latency = 0.0
+        # hot chunks kept in memory, keyed by chunk id
+        self.cache = ChunkCache(cache_bytes)
+        # the scrubber re-reads chunks no read has verified for scrub_period
+        # seconds, at most scrub_rate bytes/s; verified maps chunk id to the
+        # time its checksums last matched
+        self.scrub_rate = scrub_rate
+        self.scrub_period = scrub_period
+        self.scrub_pause = 60
+        self.verified = {}
+        self.corrupt = 0
         self.on = True
 
     def start(self):
@@ -57,37 +345,278 @@ class ChunkServer:
         if not os.access(self.local_fs_root, os.W_OK):
             print('Create directory for storage:', self.local_fs_root,)
             os.makedirs(self.local_fs_root)
+        self.store = ChunkStore(os.path.join(self.local_fs_root, '.yadstore'), self.segment_bytes)
+        self._migrate()
+        print('Chunk store holds', len(self.store.index), 'chunks in', len(self.store.segments), 'segments')
 
         print('Start sending heartbeats to', self.ns_addr)
         _thread.start_new_thread(self._heartbeat, ())
+        _thread.start_new_thread(self._scrubber, ())
+        _thread.start_new_thread(self._compactor, ())
+
+        url = urlsplit(self.addr)
+        self.data_server = DataServer(('', url.port + self.DATA_PORT_OFFSET), DataTransferHandler)
+        self.data_server.cs = self
+        print('Accept chunk transfers on port', url.port + self.DATA_PORT_OFFSET)
+        _thread.start_new_thread(self.data_server.serve_forever, ())
         print('Server is ready')
 
     def _heartbeat(self):
+        proxies = {a: ServerProxy(a) for a in self.ns_addrs}
         while self.on:
+            for ns_addr, ns in proxies.items():
+                report = self._take_report(ns_addr)
+                try:
+                    reply = ns.heartbeat(self.addr, report, self._stats())
+                except Exception as e:
+                    # the name server may come back from an older image
+                    self._restore_report(ns_addr, report)
+                    self.full_due[ns_addr] = 0
+                    continue
+                if reply.get('full_report'):
+                    self.full_due[ns_addr] = 0
+                if reply.get('delete'):
+                    print('Name server asked to delete', len(reply['delete']), 'chunks')
+                    self.delete_chunks(reply['delete'])
+            time.sleep(self.hb_timeout)
+
+    def _dispatch(self, method, params):
+        if method.startswith('_'):
+            raise Exception('method "%s" is not supported' % method)
+        func = getattr(self, method)
+        with self.stats_lock:
+            self.waiting += 1
+        with self.workers:
+            kind = 'reads' if method in self.read_methods else 'writes' if method in self.write_methods else None
+            with self.stats_lock:
+                self.waiting -= 1
+                if kind == 'reads':
+                    self.active_reads += 1
+                elif kind == 'writes':
+                    self.active_writes += 1
+            start = time.monotonic()
             try:
-                self.ns.heartbeat(self.addr)
+                return func(*params)
+            finally:
+                with self.stats_lock:
+                    if kind is not None:
+                        self.latency = 0.8 * self.latency + 0.2 * (time.monotonic() - start)
+                    if kind == 'reads':
+                        self.active_reads -= 1
+                    elif kind == 'writes':
+                        self.active_writes -= 1
+
+    def _stats(self):
+        disk = shutil.disk_usage(self.local_fs_root)
+        with self.stats_lock:
+            # byte counts as floats: XML-RPC ints stop at 2**31
+            return {'free': float(disk.free), 'used': float(disk.used), 'reads': self.active_reads,
+                    'writes': self.active_writes, 'queue': self.waiting,
+                    'latency': self.latency, 'rack': self.rack, 'cache': self.cache.stats(),
+                    'corrupt': self.corrupt, 'store': self.store.stats()}
+
+    def _owner(self, chunk_path):
+        path = '/' + chunk_path.strip('/')
+        while path not in self.mounts:
+            path = path[:path.rfind('/')] or '/'
+        return self.mounts[path]
+
+    def _record(self, chunk_path, mtime=None):
+        """Note an added (mtime given) or deleted chunk for the next report."""
+        chunk_id = '/' + chunk_path.lstrip('/')
+        ns_addr = self._owner(chunk_id)
+        with self.report_lock:
+            if mtime is None:
+                self.added[ns_addr].pop(chunk_id, None)
+                self.deleted[ns_addr].add(chunk_id)
+            else:
+                self.deleted[ns_addr].discard(chunk_id)
+                self.added[ns_addr][chunk_id] = mtime
+
+    def _take_report(self, ns_addr):
+        now = time.time()
+        with self.report_lock:
+            if now >= self.full_due[ns_addr]:
+                self.full_due[ns_addr] = now + self.full_report_interval
+                self.added[ns_addr] = {}
+                self.deleted[ns_addr] = set()
+                return {'full': [c for c in self._scan() if self._owner(c[0]) == ns_addr]}
+            report = {}
+            if self.added[ns_addr]:
+                report['added'] = list(self.added[ns_addr].items())
+                self.added[ns_addr] = {}
+            if self.deleted[ns_addr]:
+                report['deleted'] = list(self.deleted[ns_addr])
+                self.deleted[ns_addr] = set()
+            return report
+
+    def _restore_report(self, ns_addr, report):
+        with self.report_lock:
+            for chunk_id, mtime in report.get('added', ()):
+                self.added[ns_addr].setdefault(chunk_id, mtime)
+            for chunk_id in report.get('deleted', ()):
+                if chunk_id not in self.added[ns_addr]:
+                    self.deleted[ns_addr].add(chunk_id)
+
+    def _scan(self):
+        """[chunk_id, mtime] for every chunk in the store."""
+        return self.store.chunks()
+
+    def _migrate(self):
+        """Move chunks kept one file each under local_fs_root, as before the
+        chunk store, into it, with their sidecar checksums when valid."""
+        moved = 0
+        for dirpath, dirnames, filenames in os.walk(self.local_fs_root, topdown=False):
+            if dirpath == self.store.root:
+                continue
+            first = self.store.active.number
+            for fn in filenames:
+                if fn.endswith('.yadmeta') or fn.endswith('.yadtmp'):
+                    continue
+                local_path = os.path.join(dirpath, fn)
+                with open(local_path, 'rb') as f:
+                    data = f.read()
+                block_size, crcs = self._read_meta(local_path + '.yadmeta') or \
+                    (self.BLOCK_SIZE, self._block_checksums(data))
+                rel = os.path.relpath(local_path, self.local_fs_root)
+                self.store.put(rel.replace(os.sep, '/'), data, block_size, crcs,
+                               mtime=os.path.getmtime(local_path))
+                moved += 1
+            # the copies must be on disk before the originals go
+            self.store.sync(first)
+            # chunks, sidecars and temp files left by interrupted writes
+            for fn in filenames:
+                os.remove(os.path.join(dirpath, fn))
+            if dirpath != self.local_fs_root and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        if moved:
+            print('Moved', moved, 'chunk files into the chunk store')
+
+    def _read_meta(self, meta_path):
+        """(block size, [crc, ...]) from a sidecar file, None if it is unusable."""
+        try:
+            with open(meta_path, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return None
+        if len(raw) < self.META_HEADER.size:
+            return None
+        magic, block_size = self.META_HEADER.unpack_from(raw)
+        if magic != self.META_MAGIC or not block_size:
+            return None
+        count = (len(raw) - self.META_HEADER.size) // 4
+        return block_size, list(struct.unpack_from('<%dI' % count, raw, self.META_HEADER.size))
+
+    def _compactor(self):
+        while self.on:
+            time.sleep(self.compact_interval)
+            try:
+                self.store.compact()
             except Exception as e:
-                pass
-            time.sleep(self.hb_timeout)
-    
-    def implement_chunk_caching_mechanisms():
-        pass
-    # Cache frequently accessed chunks in memory or a faster storage medium
-    # to improve access performance
-    # ...
+                print('Error while compacting:', e)
+
+    def read_cached(self, chunk_path):
+        """A chunk's bytes from the cache, read into it when worth caching;
+        None when the caller should read the store itself."""
+        key = self.store.key(chunk_path)
+        data, token = self.cache.lookup(key)
+        if data is None and token is not None:
+            try:
+                data = bytes(self._read_verified(chunk_path))
+            except BaseException:
+                self.cache.invalidate(key)
+                raise
+            self.cache.put(key, data, token)
+        return data
 
-    # Simulate managing the cached chunks and evicting them when necessary
-    # ... Later
+    def _block_checksums(self, data):
+        view = memoryview(data)
+        return [zlib.crc32(view[i:i + self.BLOCK_SIZE]) for i in range(0, len(view), self.BLOCK_SIZE)]
+
+    def checksums(self, chunk_path):
+        """(block size, [crc, ...]) of a chunk."""
+        return self.store.checksums(chunk_path)
+
+    def _read_verified(self, chunk_path):
+        """A whole chunk, as a view of its segment, checked against its
+        checksums; reports it to the name server and raises ChecksumError
+        when they differ."""
+        data, block_size, crcs = self.store.get(chunk_path)
+        offsets = range(0, len(data), block_size)
+        if len(offsets) != len(crcs) or any(
+                zlib.crc32(data[i:i + block_size]) != crc for i, crc in zip(offsets, crcs)):
+            self._report_bad(chunk_path)
+            raise ChecksumError('Chunk %s failed its checksum' % chunk_path)
+        self.verified[self.store.key(chunk_path)] = time.time()
+        return data
+
+    def _report_bad(self, chunk_path):
+        chunk_id = '/' + chunk_path.lstrip('/')
+        print('Chunk', chunk_id, 'is corrupt, reporting it')
+        with self.stats_lock:
+            self.corrupt += 1
+
+        def report():
+            try:
+                ServerProxy(self._owner(chunk_id)).report_bad_chunks(self.addr, [chunk_id])
+            except Exception as e:
+                print('Failed to report corrupt chunk', chunk_id, ':', e)
+        _thread.start_new_thread(report, ())
+
+    def _scrubber(self):
+        while self.on:
+            try:
+                self.scrub()
+            except Exception as e:
+                print('Error while scrubbing:', e)
+            time.sleep(self.scrub_pause)
+
+    def scrub(self):
+        """Verify every chunk not verified for scrub_period seconds, at
+        scrub_rate bytes/s; returns the number of corrupt chunks found."""
+        corrupt = 0
+        for chunk_id, _ in self._scan():
+            if not self.on:
+                break
+            if time.time() - self.verified.get(chunk_id, 0) < self.scrub_period:
+                continue
+            start = time.monotonic()
+            try:
+                size = len(self._read_verified(chunk_id))
+            except ChecksumError:
+                corrupt += 1
+                continue
+            except FileNotFoundError:
+                # deleted meanwhile
+                continue
+            time.sleep(max(0.0, size / self.scrub_rate - (time.monotonic() - start)))
+        return corrupt
+
+    def pin_chunk(self, chunk_path):
+        """Keep a chunk in the cache until unpin_chunk, loading it now."""
+        self.cache.pin(self.store.key(chunk_path))
+        try:
+            self.read_cached(chunk_path)
+        except FileNotFoundError:
+            return {'status': Status.not_found}
+        return {'status': Status.ok}
+
+    def unpin_chunk(self, chunk_path):
+        self.cache.unpin(self.store.key(chunk_path))
+        return {'status': Status.ok}
+
+    def get_cache_stats(self):
+        return {'status': Status.ok, 'cache': self.cache.stats()}
 
-    
     def upload_chunk(self, chunk_path, chunk):
         print('Upload file', chunk_path)
-        local_path = self.chunk_filename(chunk_path)
-        ldir = os.path.dirname(local_path)
-        self.make_sure_path_exists(ldir)
-        with open(local_path, "w") as f:
-            f.write(chunk)
-            return {'status': Status.ok}
+        # chunks are raw bytes; text from older clients is stored as UTF-8
+        data = chunk.data if isinstance(chunk, Binary) else chunk.encode()
+        # synced before the upload is acknowledged, as data-port PUTs are
+        mtime = self.store.put(chunk_path, data, self.BLOCK_SIZE, self._block_checksums(data), sync=True)
+        self.cache.invalidate(self.store.key(chunk_path))
+        self._record(chunk_path, mtime)
+        return {'status': Status.ok}
 
     @staticmethod
     def check_replication_level(chunk_path):
@@ -113,10 +642,56 @@ class ChunkServer:
                 
                 
     def get_chunk(self, chunk_path):
-        local_path = self.chunk_filename(chunk_path)
-        with open(local_path, "r") as f:
-            data = f.read()
-        return data
+        # whole-chunk reads go over the data port; this is the fallback
+        data = self.read_cached(chunk_path)
+        if data is None:
+            data = bytes(self._read_verified(chunk_path))
+        return Binary(data)
+
+    get_chunk_bytes = get_chunk
+
+    def read_chunk(self, chunk_path, offset, length):
+        """Bytes [offset, offset + length) of a chunk; length 0 reads to the
+        end. Only the checksum blocks covering the range are verified."""
+        # offsets past 2**31 arrive as floats
+        offset, length = int(offset), int(length)
+        data = self.read_cached(chunk_path)
+        if data is None:
+            data, block_size, crcs = self.store.get(chunk_path)
+            end = len(data) if not length else min(len(data), offset + length)
+            for i in range(offset // block_size, -(-end // block_size)):
+                if i >= len(crcs) or zlib.crc32(data[i * block_size:(i + 1) * block_size]) != crcs[i]:
+                    self._report_bad(chunk_path)
+                    raise ChecksumError('Chunk %s failed its checksum' % chunk_path)
+        return Binary(bytes(data[offset:offset + length] if length else data[offset:]))
+
+    def reconstruct_chunk(self, chunk_path, sources, k, m, index):
+        """Rebuild erasure-coded shard number index of a chunk group here.
+
+        sources lists [shard index, chunk id, chunk server] for surviving
+        shards of the group; the first k that can be read are decoded.
+        """
+        if ReedSolomon is None:
+            print('Cannot rebuild', chunk_path, ': NumPy is not installed')
+            return {'status': Status.error}
+        shards = [None] * (k + m)
+        found = 0
+        for i, chunk_id, cs_addr in sources:
+            if found == k:
+                break
+            try:
+                shards[i] = ServerProxy(cs_addr).get_chunk_bytes(chunk_id).data
+                found += 1
+            except Exception as e:
+                print('Shard', chunk_id, 'unreadable on', cs_addr, ':', e)
+        try:
+            shard = ReedSolomon(k, m).decode(shards, [index])[0].tobytes()
+        except ValueError as e:
+            print('Cannot rebuild', chunk_path, ':', e)
+            return {'status': Status.error}
+        self.upload_chunk(chunk_path, Binary(shard))
+        print('Rebuilt', chunk_path, 'from', found, 'shards')
+        return {'status': Status.ok, 'size': len(shard)}
         
     def manage_chunk_versions(chunk_path):
     # Get the list of versions for the chunk
@@ -132,26 +707,73 @@ class ChunkServer:
 
 
     def delete_chunk(self, chunk_path):
-        local_path = self.chunk_filename(chunk_path)
-        ldir = os.path.dirname(local_path)
-        self.make_sure_path_exists(ldir)
-        if os.path.exists(local_path):
-            os.remove(local_path)
+        found = self.store.delete(chunk_path)
+        if found:
             print('Delete file', chunk_path)
-            return {'status': Status.ok}
-        else:
-            return {'status': Status.not_found}
+        key = self.store.key(chunk_path)
+        self.verified.pop(key, None)
+        self.cache.invalidate(key)
+        # reported either way: the name server resends deletes until it sees one
+        self._record(chunk_path)
+        return {'status': Status.ok if found else Status.not_found}
+
+    def delete_chunks(self, chunk_paths):
+        """Delete a batch of chunks; returns how many were found."""
+        deleted = 0
+        for chunk_path in chunk_paths:
+            try:
+                if self.delete_chunk(chunk_path)['status'] == Status.ok:
+                    deleted += 1
+            except Exception as e:
+                print('Failed to delete', chunk_path, ':', e)
+        return {'status': Status.ok, 'deleted': deleted}
 
     def replicate_chunk(self, chunk_path, cs_addr):
         try:
-            cs = ServerProxy(cs_addr)
             print("Replicate", chunk_path, 'to', cs_addr)
-            chunk = self.get_chunk(chunk_path)
-            cs.upload_chunk(chunk_path, chunk)
+            try:
+                size = self.send_chunk(chunk_path, cs_addr)
+            except ConnectionRefusedError:
+                # target without a data port
+                chunk = self.get_chunk_bytes(chunk_path)
+                ServerProxy(cs_addr).upload_chunk(chunk_path, chunk)
+                size = len(chunk.data)
             print("File", chunk_path, "has replicated to", cs_addr)
-            return "ok"
+            return {'status': Status.ok, 'size': size}
         except Exception as e:
             print("Replication of", chunk_path, 'failed:', str(e))
+            return {'status': Status.error}
+
+    def send_chunk(self, chunk_path, cs_addr):
+        """Stream a chunk to cs_addr's data port; returns the bytes sent.
+
+        Every block is checked against its checksum before it goes out; a
+        corrupt one aborts the transfer, which the target then discards.
+        """
+        url = urlsplit(cs_addr)
+        h = DataTransferHandler
+        data, block_size, crcs = self.store.get(chunk_path)
+        with socket.create_connection((url.hostname, url.port + self.DATA_PORT_OFFSET), timeout=60) as sock:
+            size = len(data)
+            if -(-size // block_size) != len(crcs):
+                self._report_bad(chunk_path)
+                raise ChecksumError('Chunk %s has %d bytes for %d checksums' % (chunk_path, size, len(crcs)))
+            chunk_id = chunk_path.encode()
+            sock.sendall(h.PUT_HEADER.pack(h.MAGIC, len(chunk_id), size) + chunk_id)
+            crc = 0
+            for i, expected in enumerate(crcs):
+                buf = data[i * block_size:(i + 1) * block_size]
+                if zlib.crc32(buf) != expected:
+                    self._report_bad(chunk_path)
+                    raise ChecksumError('Chunk %s failed its checksum' % chunk_path)
+                crc = zlib.crc32(buf, crc)
+                sock.sendall(buf)
+            sock.sendall(h.CRC.pack(crc))
+            reply = sock.recv(1)
+        if reply != bytes([h.OK]):
+            raise IOError('target answered %r' % reply)
+        self.verified[self.store.key(chunk_path)] = time.time()
+        return size
 
     def chunk_filename(self, chunk_path):
         if chunk_path[0] == '/':
@@ -160,13 +782,6 @@ class ChunkServer:
             return os.path.join(self.local_fs_root, chunk_path)
 
     @staticmethod
-    def make_sure_path_exists(path):
-        try:
-            os.makedirs(path)
-        except OSError as exception:
-            if exception.errno != errno.EEXIST:
-                raise
-    @staticmethod
     def check_chunk_health():
         """
         Checks the health of the chunks on the datanode.
@@ -216,10 +831,13 @@ if __name__ == '__main__':
     else:
         ns_addr = os.environ['YAD_NS']
 
-    cs = ChunkServer(addr, ns_addr)
+    cs = ChunkServer(addr, ns_addr, os.getenv('YAD_MOUNTS', ''), os.getenv('YAD_RACK', ''),
+                     int(os.getenv('YAD_CS_WORKERS', '8')), int(os.getenv('YAD_CACHE_BYTES', str(64 << 20))),
+                     segment_bytes=int(os.getenv('YAD_SEGMENT_BYTES', str(256 << 20))),
+                     max_chunk_bytes=int(os.getenv('YAD_MAX_CHUNK_BYTES', str(64 << 20))))
     cs.start()
 
-    server = SimpleXMLRPCServer((host, port))
+    server = ThreadedXMLRPCServer((host, port))
     server.register_introspection_functions()
     server.register_instance(cs)
     server.serve_forever()
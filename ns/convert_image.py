@@ -0,0 +1,39 @@
+#!/usr/bin/env python3.11
+# Convert a YAML metadata dump into the binary namespace image.
+#
+#   python3 convert_image.py metadata.yml metadata.img
+#
+# The edit log next to the dump (metadata.yml.edits) is copied along, so
+# the name server replays it on top of the converted image.
+import os
+import shutil
+import sys
+import time
+
+from name_server import FsImage
+
+
+def convert(src, dst):
+    start = time.time()
+    root, txid = FsImage.load_yaml(src)
+    print('Loaded', src, 'at txid', txid, 'in %.2fs' % (time.time() - start))
+
+    tmp = dst + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(FsImage.dumps(root, txid))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, dst)
+    print('Wrote', dst, '(%d bytes)' % os.path.getsize(dst))
+
+    for suffix in ('.edits.prev', '.edits'):
+        if os.path.isfile(src + suffix):
+            shutil.copyfile(src + suffix, dst + suffix)
+            print('Copied edit log', src + suffix, 'to', dst + suffix)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: convert_image.py <metadata.yml> <metadata.img>')
+        sys.exit(1)
+    convert(sys.argv[1], sys.argv[2])
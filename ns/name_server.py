@@ -1,18 +1,26 @@
 #!/usr/bin/env python3.11
 import os
 import random
+import shutil
 import sys
 import yaml
 import _thread
 import socket
 from datetime import datetime
 from xmlrpc.server import SimpleXMLRPCServer
+from socketserver import ThreadingMixIn
 from xmlrpc.client import ServerProxy
 import time
-from queue import Queue
 import threading
 import json
 import ssl
+import mmap
+import struct
+import bisect
+import heapq
+import fnmatch
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 class NodeType:
     directory = 2
@@ -50,11 +58,25 @@ class FileNode:
     def __init__(self, name, node_type):
         self.name = name
         self.parent = None
-        self.children = []
+        self.children = {}
         self.type = node_type
+        # totals for the subtree rooted here, kept up to date on every
+        # change so size lookups never walk the tree
         self._size = 0
+        self.file_count = 1 if node_type == NodeType.file else 0
+        self.chunk_count = 0
         self.date = time.time()
         self.chunks = {}
+        # chunk id -> bytes, for ranged reads; empty for files written
+        # before sizes were recorded
+        self.chunk_sizes = {}
+        # copies to keep of each chunk; None inherits the parent's factor
+        self.replication = None
+        # [k, m, shard size] for erasure-coded files; each chunk is then one
+        # shard '<path>_ec<group>_<index>' stored once
+        self.ec = None
+        # sorted child names, built on the first paged listing
+        self._sorted_names = None
 
     @property
     def is_root(self):
@@ -62,9 +84,6 @@ class FileNode:
 
     @property
     def size(self):
-        if self.type == NodeType.directory:
-            return sum(c.size for c in self.children)
-
         return self._size
     
     #not needed, covered elsewhere
@@ -81,30 +100,93 @@ class FileNode:
     
     @size.setter
     def size(self, value):
-        self._size = value
+        if self.type == NodeType.file:
+            self._add_to_totals(value - self._size, 0, 0)
+
+    def _add_to_totals(self, size, files, chunks):
+        node = self
+        while node is not None:
+            node._size += size
+            node.file_count += files
+            node.chunk_count += chunks
+            node = node.parent
 
     def add_child(self, child):
-        self.children.append(child)
+        self.children[child.name] = child
         child.parent = self
+        self._add_to_totals(child._size, child.file_count, child.chunk_count)
+        if self._sorted_names is not None:
+            bisect.insort(self._sorted_names, child.name)
+
+    def sorted_child_names(self):
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self.children)
+        return self._sorted_names
+
+    def effective_replication(self, default):
+        node = self
+        while node is not None:
+            if node.replication is not None:
+                return node.replication
+            node = node.parent
+        return default
+
+    def add_chunk(self, chunk_id, replicas):
+        if chunk_id not in self.chunks:
+            self._add_to_totals(0, 0, 1)
+        self.chunks[chunk_id] = replicas
+
+    def clear_chunks(self):
+        self._add_to_totals(0, 0, -len(self.chunks))
+        self.chunks = {}
+        self.chunk_sizes = {}
 
     #not working (extra)    
     def find_file_by_extension(self, extension):
-        for child in self.children:
+        for child in self.children.values():
             if child.type == NodeType.file and child.name.lower().endswith(extension):
                 return child
         return None
 
     def find_path(self, path):
-        if path == self.name:
-            return self
-
-        ch_name, ch_path = self._extract_child_path_and_name(path)
-
-        for child in self.children:
-            if child.name == ch_name:
-                return child.find_path(ch_path)
+        node = self
+        for name in path.strip('/').split('/'):
+            if not name:
+                continue
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
 
-        return None
+    def upgrade(self):
+        # dumps written before children were keyed by name hold a list, and
+        # none of them carry the subtree totals
+        order = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node.children, list):
+                node.children = {c.name: c for c in node.children}
+            if not hasattr(node, 'replication'):
+                node.replication = None
+            if not hasattr(node, 'ec'):
+                node.ec = None
+            if not hasattr(node, 'chunk_sizes'):
+                node.chunk_sizes = {}
+            node._sorted_names = None
+            order.append(node)
+            stack.extend(node.children.values())
+
+        for node in reversed(order):
+            if node.type == NodeType.file:
+                node.file_count = 1
+                node.chunk_count = len(node.chunks)
+            else:
+                children = node.children.values()
+                node._size = sum(c._size for c in children)
+                node.file_count = sum(c.file_count for c in children)
+                node.chunk_count = sum(c.chunk_count for c in children)
+        return self
 
     @staticmethod
     def _extract_child_path_and_name(path):
@@ -170,7 +252,7 @@ class FileNode:
         while i < len(dirs):
             d_name = dirs[i]
 
-            directory = next((x for x in curr_dir.children if x.name == d_name), None)
+            directory = curr_dir.children.get(d_name)
             if directory is None:
                 directory = FileNode(d_name, NodeType.directory)
                 curr_dir.add_child(directory)
@@ -219,7 +301,12 @@ class FileNode:
 
     def delete(self):
         if not self.is_root:
-            self.parent.children.remove(self)
+            parent = self.parent
+            del parent.children[self.name]
+            parent._add_to_totals(-self._size, -self.file_count, -self.chunk_count)
+            if parent._sorted_names is not None:
+                names = parent._sorted_names
+                del names[bisect.bisect_left(names, self.name)]
             self.parent = None
 
     def append_to_file(self, path, content):
@@ -248,10 +335,987 @@ class FileNode:
 
         return path
 
+class RWLock:
+    """Many readers or one writer. Waiting writers block new readers so a
+    steady stream of reads can't starve mutations. Not reentrant."""
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class ThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """XML-RPC server that handles each connection on its own thread.
+
+    Calls in fast_path (heartbeats) run straight away; everything else waits
+    for one of max_workers slots, so a burst of slow listings can't pile up
+    namespace work or hold heartbeats back.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+    fast_path = ('heartbeat',)
+
+    def __init__(self, addr, max_workers=16, **kwargs):
+        super().__init__(addr, **kwargs)
+        self.workers = threading.BoundedSemaphore(max_workers)
+
+    def _dispatch(self, method, params):
+        if method in self.fast_path:
+            return super()._dispatch(method, params)
+        with self.workers:
+            return super()._dispatch(method, params)
+
+
+class PathCache:
+    """Bounded LRU map of full path -> FileNode.
+
+    Entries are dropped on create and delete, so a hit is always a node
+    that is still attached to the tree. Deleting a directory does not sweep
+    out the entries below it: it starts a new epoch, and an entry cached in
+    an older one is checked against the tree when it is next hit.
+    """
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        # path -> (node, epoch it was last known attached in)
+        self.items = OrderedDict()
+        self.epoch = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _attached(path, node):
+        """Whether node is still reached from the root by path's names."""
+        for name in reversed(path.split('/')[1:] if path != '/' else []):
+            parent = node.parent
+            if node.name != name or parent is None or parent.children.get(name) is not node:
+                return False
+            node = parent
+        return node.is_root
+
+    def get(self, path):
+        with self.lock:
+            entry = self.items.get(path)
+            if entry is not None and entry[1] != self.epoch:
+                if self._attached(path, entry[0]):
+                    entry = self.items[path] = (entry[0], self.epoch)
+                else:
+                    del self.items[path]
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(path)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, path, node):
+        with self.lock:
+            self.items[path] = (node, self.epoch)
+            self.items.move_to_end(path)
+            if len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+    def invalidate(self, path, recursive=False):
+        with self.lock:
+            self.items.pop(path, None)
+            if recursive:
+                self.epoch += 1
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class _DumpLoader(yaml.Loader):
+    # YAML dumps name the class after the module that wrote them, which is
+    # __main__ when the name server runs as a script
+    def find_python_name(self, name, mark, unsafe=False):
+        if name.rsplit('.', 1)[-1] == 'FileNode':
+            return FileNode
+        return super().find_python_name(name, mark, unsafe)
+
+
+class FsImage:
+    """Binary namespace image.
+
+    Layout (little-endian):
+        header      magic, version, txid, node count, server count
+        servers     u16 length + address, referenced by index below
+        nodes       preorder; each path is stored as the length of the prefix
+                    shared with the previous path plus the remaining bytes,
+                    followed by type, size, date and replication factor
+                    (0 = inherited; not present in version 1 images)
+        chunks      per file with chunks: node index, chunk count, then each
+                    chunk id (relative to the file path), replica indices
+                    and size (NO_SIZE if unknown; version 4 on)
+        ec          per erasure-coded file: node index, k, m and shard size
+                    (version 3 on)
+        root        replication factor of the root, 0 if unset (version 5 on)
+
+    Nodes come in preorder, so the loader rebuilds the tree in one pass over
+    a memory-mapped file with a stack of open directories.
+    """
+    MAGIC = b'YADFSIMG'
+    VERSION = 5
+    NO_SIZE = 0xffffffff
+
+    HEADER = struct.Struct('<8sHQII')
+    NODE = struct.Struct('<IIBQdB')
+    NODE_V1 = struct.Struct('<IIBQd')
+    FILE_CHUNKS = struct.Struct('<II')
+    CHUNK = struct.Struct('<BH')
+    EC = struct.Struct('<IBBI')
+    U8 = struct.Struct('<B')
+    U16 = struct.Struct('<H')
+    U32 = struct.Struct('<I')
+
+    @staticmethod
+    def is_image(path):
+        with open(path, 'rb') as f:
+            return f.read(len(FsImage.MAGIC)) == FsImage.MAGIC
+
+    @staticmethod
+    def dumps(root, txid):
+        nodes = bytearray()
+        chunks = bytearray()
+        servers = {}
+        ec = bytearray()
+        n_nodes = 0
+        n_files = 0
+        n_ec = 0
+        prev = ''
+
+        stack = [(child, '') for child in reversed(list(root.children.values()))]
+        while stack:
+            node, parent_path = stack.pop()
+            path = parent_path + '/' + node.name
+            shared = 0
+            limit = min(len(prev), len(path))
+            while shared < limit and prev[shared] == path[shared]:
+                shared += 1
+            suffix = path[shared:].encode()
+            size = 0 if node.type == NodeType.directory else node.size
+            nodes += FsImage.NODE.pack(shared, len(suffix), node.type, size, node.date, node.replication or 0)
+            nodes += suffix
+            prev = path
+
+            if node.chunks:
+                chunks += FsImage.FILE_CHUNKS.pack(n_nodes, len(node.chunks))
+                for chunk_id, replicas in node.chunks.items():
+                    relative = chunk_id.startswith(path)
+                    name = (chunk_id[len(path):] if relative else chunk_id).encode()
+                    chunks += FsImage.CHUNK.pack(relative, len(name)) + name
+                    ids = [servers.setdefault(cs, len(servers)) for cs in replicas]
+                    chunks += struct.pack('<B%dH' % len(ids), len(ids), *ids)
+                    chunks += FsImage.U32.pack(node.chunk_sizes.get(chunk_id, FsImage.NO_SIZE))
+                n_files += 1
+            if node.ec:
+                ec += FsImage.EC.pack(n_nodes, *node.ec)
+                n_ec += 1
+
+            n_nodes += 1
+            for child in reversed(list(node.children.values())):
+                stack.append((child, path))
+
+        out = bytearray(FsImage.HEADER.pack(FsImage.MAGIC, FsImage.VERSION, txid, n_nodes, len(servers)))
+        for cs in servers:
+            addr = cs.encode()
+            out += FsImage.U16.pack(len(addr)) + addr
+        out += nodes
+        out += FsImage.U32.pack(n_files)
+        out += chunks
+        out += FsImage.U32.pack(n_ec)
+        out += ec
+        out += FsImage.U8.pack(root.replication or 0)
+        return bytes(out)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return FsImage.loads(buf)
+
+    @staticmethod
+    def loads(buf):
+        magic, version, txid, n_nodes, n_servers = FsImage.HEADER.unpack_from(buf, 0)
+        if magic != FsImage.MAGIC:
+            raise ValueError('Not a namespace image')
+        if version > FsImage.VERSION:
+            raise ValueError('Unsupported namespace image version %d' % version)
+        off = FsImage.HEADER.size
+
+        servers = []
+        for _ in range(n_servers):
+            (n,) = FsImage.U16.unpack_from(buf, off)
+            off += FsImage.U16.size
+            servers.append(buf[off:off + n].decode())
+            off += n
+
+        root = FileNode('/', NodeType.directory)
+        nodes = []
+        paths = []
+        stack = [('', root)]
+        prev = ''
+        node_struct = FsImage.NODE if version >= 2 else FsImage.NODE_V1
+        unpack_node = node_struct.unpack_from
+        node_size = node_struct.size
+        replication = 0
+        for _ in range(n_nodes):
+            if version >= 2:
+                shared, n, node_type, size, date, replication = unpack_node(buf, off)
+            else:
+                shared, n, node_type, size, date = unpack_node(buf, off)
+            off += node_size
+            path = prev[:shared] + buf[off:off + n].decode()
+            off += n
+            prev = path
+
+            sep = path.rfind('/')
+            parent_path = path[:sep]
+            while stack[-1][0] != parent_path:
+                stack.pop()
+            node = FileNode(path[sep + 1:], node_type)
+            node.date = date
+            if replication:
+                node.replication = replication
+            stack[-1][1].add_child(node)
+            if node_type == NodeType.directory:
+                stack.append((path, node))
+            else:
+                node.size = size
+            nodes.append(node)
+            paths.append(path)
+
+        (n_files,) = FsImage.U32.unpack_from(buf, off)
+        off += FsImage.U32.size
+        for _ in range(n_files):
+            index, n_chunks = FsImage.FILE_CHUNKS.unpack_from(buf, off)
+            off += FsImage.FILE_CHUNKS.size
+            node = nodes[index]
+            path = paths[index]
+            for _ in range(n_chunks):
+                relative, n = FsImage.CHUNK.unpack_from(buf, off)
+                off += FsImage.CHUNK.size
+                name = buf[off:off + n].decode()
+                off += n
+                (n_replicas,) = struct.unpack_from('<B', buf, off)
+                off += 1
+                ids = struct.unpack_from('<%dH' % n_replicas, buf, off)
+                off += 2 * n_replicas
+                chunk_id = path + name if relative else name
+                node.add_chunk(chunk_id, [servers[i] for i in ids])
+                if version >= 4:
+                    (size,) = FsImage.U32.unpack_from(buf, off)
+                    off += FsImage.U32.size
+                    if size != FsImage.NO_SIZE:
+                        node.chunk_sizes[chunk_id] = size
+
+        if version >= 3:
+            (n_ec,) = FsImage.U32.unpack_from(buf, off)
+            off += FsImage.U32.size
+            for _ in range(n_ec):
+                index, k, m, shard = FsImage.EC.unpack_from(buf, off)
+                off += FsImage.EC.size
+                nodes[index].ec = [k, m, shard]
+
+        if version >= 5:
+            (replication,) = FsImage.U8.unpack_from(buf, off)
+            if replication:
+                root.replication = replication
+
+        return root, txid
+
+    @staticmethod
+    def load_yaml(path):
+        """Read a YAML dump written before the binary image existed."""
+        with open(path) as f:
+            image = yaml.load(f, Loader=_DumpLoader)
+        if isinstance(image, dict):
+            return image['root'].upgrade(), image['txid']
+        # dumps written before the edit log are a bare tree
+        return image.upgrade(), 0
+
+
+class EditLog:
+    """Append-only log of namespace mutations, one JSON record per line.
+
+    append() only buffers the record; sync(txid) returns once every record
+    up to txid is on disk. Callers that reach sync() while an fsync is in
+    flight are covered by the next one, so concurrent writers share fsyncs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.prev_path = path + '.prev'
+        self.txid = 0
+        self.synced_txid = 0
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.f = None
+        # path -> bytes up to the end of its last whole record, set by read()
+        self.valid_end = {}
+
+    def open(self, txid):
+        self.txid = txid
+        self.synced_txid = txid
+        # cut off a torn tail: records appended after it would be lost with it
+        for path, end in self.valid_end.items():
+            if os.path.isfile(path) and os.path.getsize(path) > end:
+                print("Truncating edit log", path, "to", end, "bytes")
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+                    os.fsync(f.fileno())
+        self.f = open(self.path, 'a')
+
+    def close(self):
+        if self.f is not None:
+            self.sync(self.txid)
+            self.f.close()
+            self.f = None
+
+    def append(self, op):
+        with self.lock:
+            self.txid += 1
+            op['t'] = self.txid
+            self.f.write(json.dumps(op, separators=(',', ':')) + '\n')
+            return self.txid
+
+    def sync(self, txid):
+        if txid <= self.synced_txid:
+            return
+        with self.sync_lock:
+            if txid <= self.synced_txid:
+                return
+            with self.lock:
+                last = self.txid
+                self.f.flush()
+            os.fsync(self.f.fileno())
+            self.synced_txid = last
+
+    def roll(self):
+        """Set the current segment aside and start a new one.
+
+        Returns the txid the set-aside segment ends at. A segment left over
+        from a checkpoint that never finished is kept and extended.
+        """
+        with self.sync_lock, self.lock:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
+            if os.path.isfile(self.prev_path):
+                with open(self.prev_path, 'a') as prev, open(self.path) as cur:
+                    prev.write(cur.read())
+                    prev.flush()
+                    os.fsync(prev.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.prev_path)
+            self.f = open(self.path, 'a')
+            self.synced_txid = self.txid
+            return self.txid
+
+    def purge_prev(self):
+        if os.path.isfile(self.prev_path):
+            os.remove(self.prev_path)
+
+    def read(self, after_txid):
+        """Yield records newer than after_txid from both segments, noting in
+        valid_end where the whole records of each end."""
+        self.valid_end = {}
+        for path in (self.prev_path, self.path):
+            if not os.path.isfile(path):
+                continue
+            end = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('no newline')
+                        op = json.loads(line)
+                    except ValueError:
+                        # torn tail of a write cut short by a crash
+                        print("Skipping corrupt edit log record in", path)
+                        break
+                    end += len(line)
+                    if op['t'] > after_txid:
+                        yield op
+            self.valid_end[path] = end
+
+
+class BlockInfo:
+    __slots__ = ('file', 'replicas')
+
+    def __init__(self, file, replicas):
+        self.file = file
+        # the same list object as file.chunks[chunk_id]
+        self.replicas = replicas
+
+
+class BlockMap:
+    """Chunk id -> BlockInfo(file, replicas) and chunk server -> chunk ids.
+
+    Replication, failure handling and deletion go through here instead of
+    walking the namespace. Mutated under the namespace write lock.
+    """
+
+    def __init__(self, invalidations=None):
+        self.blocks = {}
+        self.servers = {}
+        # copies (re)added here must not be deleted by a pending invalidation
+        self.invalidations = invalidations
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def get(self, chunk_id):
+        return self.blocks.get(chunk_id)
+
+    def add(self, chunk_id, file):
+        replicas = file.chunks[chunk_id]
+        self.blocks[chunk_id] = BlockInfo(file, replicas)
+        for cs in replicas:
+            self.servers.setdefault(cs, set()).add(chunk_id)
+            if self.invalidations is not None:
+                self.invalidations.cancel(chunk_id, cs)
+
+    def add_file(self, file):
+        for chunk_id in file.chunks:
+            self.add(chunk_id, file)
+
+    def add_replica(self, chunk_id, cs):
+        info = self.blocks.get(chunk_id)
+        if info is None or cs in info.replicas:
+            return False
+        info.replicas.append(cs)
+        self.servers.setdefault(cs, set()).add(chunk_id)
+        if self.invalidations is not None:
+            self.invalidations.cancel(chunk_id, cs)
+        return True
+
+    def remove_replica(self, chunk_id, cs):
+        info = self.blocks.get(chunk_id)
+        if info is None or cs not in info.replicas:
+            return False
+        info.replicas.remove(cs)
+        chunk_ids = self.servers.get(cs)
+        if chunk_ids is not None:
+            chunk_ids.discard(chunk_id)
+        return True
+
+    def remove_tree(self, node):
+        """Forget every chunk under node; returns chunk id -> replicas."""
+        removed = {}
+        stack = [node]
+        while stack:
+            item = stack.pop()
+            stack.extend(item.children.values())
+            for chunk_id in item.chunks:
+                info = self.blocks.pop(chunk_id, None)
+                if info is None:
+                    continue
+                removed[chunk_id] = list(info.replicas)
+                for cs in info.replicas:
+                    chunk_ids = self.servers.get(cs)
+                    if chunk_ids is not None:
+                        chunk_ids.discard(chunk_id)
+        return removed
+
+    def chunks_on(self, cs):
+        return list(self.servers.get(cs, ()))
+
+    def rebuild(self, root):
+        self.blocks = {}
+        self.servers = {}
+        stack = [root]
+        while stack:
+            item = stack.pop()
+            stack.extend(item.children.values())
+            self.add_file(item)
+
+
+class SortedPaths:
+    """A sorted list of paths with its changes applied when it is next read.
+
+    Additions and removals are only recorded until then. A few are applied
+    with bisect, each an insert or delete in place; a batch of more than
+    BATCH is merged by one sort or dropped by one filtering pass, so bulk
+    loads and subtree deletes stay linear.
+    """
+    __slots__ = ('items', 'added', 'removed')
+    BATCH = 128
+
+    def __init__(self):
+        self.items = []
+        self.added = []
+        self.removed = set()
+
+    def __len__(self):
+        return len(self.items) + len(self.added) - len(self.removed)
+
+    def add(self, path):
+        if path in self.removed:
+            # still in items or added
+            self.removed.discard(path)
+        else:
+            self.added.append(path)
+
+    def remove(self, path):
+        self.removed.add(path)
+
+    def sorted(self):
+        items = self.items
+        if self.added:
+            if len(self.added) > self.BATCH:
+                items.extend(self.added)
+                items.sort()
+            else:
+                for path in self.added:
+                    bisect.insort(items, path)
+            self.added = []
+        if self.removed:
+            if len(self.removed) > self.BATCH:
+                removed = self.removed
+                self.items = items = [p for p in items if p not in removed]
+            else:
+                for path in self.removed:
+                    i = bisect.bisect_left(items, path)
+                    if i < len(items) and items[i] == path:
+                        del items[i]
+            self.removed = set()
+        return items
+
+
+class NamespaceIndex:
+    """Search indexes kept up to date on create and delete.
+
+    nodes maps every full path to its node, by_name and by_ext map a name or
+    file extension to the SortedPaths that carry it, and paths holds every
+    path in sorted order for prefix ranges. Sorted lists are brought up to
+    date under sort_lock by the first query that reads them after a change.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.by_name = {}
+        self.by_ext = {}
+        self.paths = SortedPaths()
+        self.sort_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @staticmethod
+    def extension(name):
+        i = name.rfind('.')
+        return name[i:].lower() if i > 0 else ''
+
+    def add(self, path, node):
+        """Index node at path along with any ancestors not indexed yet."""
+        while node is not None and not node.is_root and path not in self.nodes:
+            self.nodes[path] = node
+            self.by_name.setdefault(node.name, SortedPaths()).add(path)
+            if node.type == NodeType.file:
+                self.by_ext.setdefault(self.extension(node.name), SortedPaths()).add(path)
+            self.paths.add(path)
+            node = node.parent
+            path = path[:path.rfind('/')]
+
+    def remove(self, path, node):
+        """Drop node at path and its whole subtree."""
+        stack = [(path, node)]
+        while stack:
+            path, node = stack.pop()
+            if self.nodes.pop(path, None) is None:
+                continue
+            self._discard(self.by_name, node.name, path)
+            if node.type == NodeType.file:
+                self._discard(self.by_ext, self.extension(node.name), path)
+            self.paths.remove(path)
+            for name, child in node.children.items():
+                stack.append((path + '/' + name, child))
+
+    @staticmethod
+    def _discard(index, key, path):
+        paths = index.get(key)
+        if paths is not None:
+            paths.remove(path)
+            if not paths:
+                del index[key]
+
+    def rebuild(self, root):
+        self.__init__()
+        stack = [('', root)]
+        while stack:
+            path, node = stack.pop()
+            for name, child in node.children.items():
+                child_path = path + '/' + name
+                self.add(child_path, child)
+                stack.append((child_path, child))
+
+    def sorted_paths(self, paths=None):
+        """The sorted list of paths (default: every path)."""
+        with self.sort_lock:
+            return (self.paths if paths is None else paths).sorted()
+
+    def under(self, prefix, start_after=''):
+        """Yield indexed paths below prefix in sorted order."""
+        paths = self.sorted_paths()
+        base = prefix.rstrip('/') + '/'
+        lo = bisect.bisect_left(paths, base)
+        if start_after:
+            lo = max(lo, bisect.bisect_right(paths, start_after))
+        for i in range(lo, len(paths)):
+            path = paths[i]
+            if not path.startswith(base):
+                return
+            yield path
+
+    def keyed(self, index, key, start_after=''):
+        """Yield the paths by_name or by_ext holds for key, in sorted order."""
+        if key not in index:
+            return
+        paths = self.sorted_paths(index[key])
+        for i in range(bisect.bisect_right(paths, start_after) if start_after else 0, len(paths)):
+            yield paths[i]
+
+
+class HeartbeatTracker:
+    """Chunk server liveness, ordered by heartbeat deadline.
+
+    Each server has at most one entry in a heap keyed by the monotonic time
+    its heartbeat is due. A single thread sleeps until the earliest
+    deadline; an entry whose server has beaten since is pushed back with
+    its new deadline, otherwise the server is forgotten and on_lost(addr)
+    fires exactly once.
+    """
+
+    def __init__(self, timeout, on_lost):
+        self.timeout = timeout
+        self.on_lost = on_lost
+        self.last = {}
+        self.heap = []
+        self.queued = set()
+        self.cond = threading.Condition()
+        self.on = True
+
+    def __contains__(self, addr):
+        return addr in self.last
+
+    def __len__(self):
+        return len(self.last)
+
+    def beat(self, addr):
+        """Record a heartbeat; True when addr was not known before."""
+        now = time.monotonic()
+        with self.cond:
+            new = addr not in self.last
+            self.last[addr] = now
+            if addr not in self.queued:
+                self.queued.add(addr)
+                heapq.heappush(self.heap, (now + self.timeout, addr))
+                self.cond.notify()
+            return new
+
+    def forget(self, addr):
+        with self.cond:
+            return self.last.pop(addr, None) is not None
+
+    def is_alive(self, addr):
+        last = self.last.get(addr)
+        return last is not None and time.monotonic() - last <= self.timeout
+
+    def snapshot(self):
+        with self.cond:
+            return list(self.last)
+
+    def run(self):
+        while self.on:
+            lost = None
+            with self.cond:
+                if not self.heap:
+                    self.cond.wait(1)
+                    continue
+                deadline, addr = self.heap[0]
+                now = time.monotonic()
+                if deadline > now:
+                    self.cond.wait(deadline - now)
+                    continue
+                heapq.heappop(self.heap)
+                last = self.last.get(addr)
+                if last is not None and last + self.timeout > now:
+                    heapq.heappush(self.heap, (last + self.timeout, addr))
+                else:
+                    self.queued.discard(addr)
+                    if last is not None:
+                        del self.last[addr]
+                        lost = addr
+            if lost is not None:
+                try:
+                    self.on_lost(lost)
+                except Exception as e:
+                    print('Error handling loss of', lost, ':', e)
+
+
+class ReplicationQueue:
+    """Chunks waiting for a new replica, most endangered first.
+
+    Ordered by (live replicas, time first queued). A chunk sits in the queue
+    at most once: queuing it again with fewer live replicas raises its
+    priority, and queuing it while a worker has it only asks for a recheck
+    once that worker calls done().
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.in_flight = set()
+        self.recheck = set()
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.entries)
+
+    def put(self, chunk_id, live):
+        with self.cond:
+            if chunk_id in self.in_flight:
+                self.recheck.add(chunk_id)
+                return False
+            entry = self.entries.get(chunk_id)
+            if entry is not None and entry[0] <= live:
+                return False
+            since = entry[1] if entry is not None else time.time()
+            self.entries[chunk_id] = (live, since)
+            heapq.heappush(self.heap, (live, since, chunk_id))
+            self.cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        """Pop the most endangered chunk, or None after timeout."""
+        with self.cond:
+            while True:
+                while self.heap:
+                    live, since, chunk_id = heapq.heappop(self.heap)
+                    # skip entries superseded by a higher-priority put
+                    if self.entries.get(chunk_id) == (live, since):
+                        del self.entries[chunk_id]
+                        self.in_flight.add(chunk_id)
+                        return chunk_id
+                if not self.cond.wait(timeout):
+                    return None
+
+    def done(self, chunk_id):
+        """Release chunk_id; True if it was queued again meanwhile."""
+        with self.cond:
+            self.in_flight.discard(chunk_id)
+            if chunk_id in self.recheck:
+                self.recheck.discard(chunk_id)
+                return True
+            return False
+
+
+class InvalidationQueue:
+    """Chunk copies waiting to be deleted, per chunk server.
+
+    Deletions are handed out in batches of at most batch ids with heartbeat
+    replies and stay pending until the server's block report shows the copy
+    gone; a batch not acknowledged within retry seconds is sent again. New
+    entries wait delay seconds first, a trash period during which a mistaken
+    delete can still be undone by restoring the metadata. Ids are kept in
+    the chunk servers' form, with a leading '/'.
+    """
+
+    def __init__(self, delay=0, retry=30, batch=1000):
+        self.delay = delay
+        self.retry = retry
+        self.batch = batch
+        # chunk server -> chunk id -> [due time, time sent or None]
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(ids) for ids in self.pending.values())
+
+    @staticmethod
+    def _key(chunk_id):
+        return '/' + chunk_id.lstrip('/')
+
+    def add(self, chunks, delay=None):
+        """Queue chunk id -> chunk servers for deletion."""
+        due = time.time() + (self.delay if delay is None else delay)
+        with self.lock:
+            for chunk_id, servers in chunks.items():
+                key = self._key(chunk_id)
+                for cs in servers:
+                    self.pending.setdefault(cs, {})[key] = [due, None]
+
+    def cancel(self, chunk_id, cs):
+        """Keep the copy of chunk_id on cs, e.g. after it was taken back."""
+        with self.lock:
+            ids = self.pending.get(cs)
+            if ids and ids.pop(self._key(chunk_id), None) and not ids:
+                del self.pending[cs]
+
+    def waiting(self, cs, chunk_id):
+        with self.lock:
+            return self._key(chunk_id) in self.pending.get(cs, ())
+
+    def holders(self, chunk_id):
+        """Chunk servers with a copy of chunk_id queued for deletion."""
+        key = self._key(chunk_id)
+        with self.lock:
+            return [cs for cs, ids in self.pending.items() if key in ids]
+
+    def take(self, cs):
+        """Next batch for cs: due entries never sent or sent retry seconds ago."""
+        now = time.time()
+        batch = []
+        with self.lock:
+            for key, entry in self.pending.get(cs, {}).items():
+                if entry[0] <= now and (entry[1] is None or entry[1] <= now - self.retry):
+                    entry[1] = now
+                    batch.append(key)
+                    if len(batch) >= self.batch:
+                        break
+        return batch
+
+    def ack(self, cs, chunk_ids):
+        """The copies of chunk_ids are gone from cs."""
+        with self.lock:
+            ids = self.pending.get(cs)
+            if not ids:
+                return
+            for chunk_id in chunk_ids:
+                ids.pop(self._key(chunk_id), None)
+            if not ids:
+                del self.pending[cs]
+
+    def keep_only(self, cs, chunk_ids):
+        """Ack everything pending on cs that a full report no longer lists."""
+        present = {self._key(c) for c in chunk_ids}
+        with self.lock:
+            ids = self.pending.get(cs)
+            if not ids:
+                return
+            for key in [k for k in ids if k not in present]:
+                del ids[key]
+            if not ids:
+                del self.pending[cs]
+
+
+class BlockReportQueue:
+    """Block reports waiting to be reconciled, applied by one thread.
+
+    heartbeat only queues a report, so a beat never waits for the namespace
+    lock. Reports are applied in arrival order; a full report replaces the
+    ones its server still has queued. The chunk ids a report says to delete
+    go out with that server's next heartbeat reply.
+    """
+
+    def __init__(self, apply):
+        self.apply = apply
+        self.queue = deque()
+        # chunk server -> chunk ids to hand out with its next heartbeat
+        self.deletes = {}
+        self.busy = 0
+        self.cond = threading.Condition()
+        self.on = True
+
+    def __len__(self):
+        with self.cond:
+            return len(self.queue) + self.busy
+
+    def put(self, cs, report):
+        with self.cond:
+            if 'full' in report:
+                self.queue = deque(item for item in self.queue if item[0] != cs)
+            self.queue.append((cs, report))
+            self.cond.notify()
+
+    def take(self, cs):
+        with self.cond:
+            return self.deletes.pop(cs, [])
+
+    def run(self):
+        while self.on:
+            with self.cond:
+                if not self.queue:
+                    self.cond.wait(1)
+                    continue
+                cs, report = self.queue.popleft()
+                self.busy = 1
+            delete = []
+            try:
+                delete = self.apply(cs, report)
+            except Exception as e:
+                print('Error processing block report from', cs, ':', e)
+            with self.cond:
+                self.busy = 0
+                if delete:
+                    self.deletes.setdefault(cs, []).extend(delete)
+
+
 class Replicator:
-    def __init__(self, ns):
+    def __init__(self, ns, workers=4, max_workers=16, source_streams=2, target_streams=2):
         self.ns = ns
-        self.queue = Queue()
+        self.queue = ReplicationQueue()
+        self.workers = workers
+        self.max_workers = max_workers
+        # concurrent copies a chunk server may send / receive
+        self.source_streams = source_streams
+        self.target_streams = target_streams
+        self.streams_out = {}
+        self.streams_in = {}
+        self.streams_lock = threading.Lock()
+        # chunks whose source or target was at its stream limit, retried later
+        self.deferred = []
+        self.deferred_lock = threading.Lock()
+        self.retry_delay = 0.5
         self.on = True
 
     def distribute_chunk_replicas(chunk_path, replicas):
@@ -268,27 +1332,84 @@ class Replicator:
 
     
     def start(self):
-        print('Start replication workers')
-        _thread.start_new_thread(self._replicate_worker, ())
-        _thread.start_new_thread(self.server_watcher, ())
+        print('Start', self.workers, 'replication workers')
+        for _ in range(self.workers):
+            _thread.start_new_thread(self._replicate_worker, ())
+        _thread.start_new_thread(self._retry_deferred, ())
 
-    #
     def balance_replication_load(self):
+        """Add one worker to the pool, up to max_workers."""
         try:
+            if self.workers >= self.max_workers:
+                return False
+            self.workers += 1
             _thread.start_new_thread(self._replicate_worker, ())
             return True
         except Exception as e:
             print("Error balancing replication load:", e)
             return False
 
-    def put_in_queue(self, path, existing_cs):
-        item = (path, existing_cs)
-        self.queue.put(item)
+    def put_in_queue(self, path):
+        with self.ns.lock.read():
+            info = self.ns.blocks.get(path)
+            live = 0 if info is None else self.ns._live_replicas(info)
+        self.queue.put(path, live)
 
     def _replicate_worker(self):
         while self.on:
-            item = self.queue.get()
-            self.replicate(item)
+            path = self.queue.get(timeout=1)
+            if path is None:
+                continue
+            try:
+                self.replicate(path)
+            except Exception as e:
+                print('Error during replication of', path, ':', e)
+            if self.queue.done(path):
+                self.put_in_queue(path)
+
+    def _defer(self, path):
+        with self.deferred_lock:
+            self.deferred.append((time.time() + self.retry_delay, path))
+
+    def _retry_deferred(self):
+        while self.on:
+            time.sleep(self.retry_delay / 2)
+            now = time.time()
+            with self.deferred_lock:
+                due = [p for t, p in self.deferred if t <= now]
+                self.deferred = [(t, p) for t, p in self.deferred if t > now]
+            for path in due:
+                self.put_in_queue(path)
+
+    def _acquire_streams(self, sources, avoid=()):
+        """Reserve a stream on the least busy source and on a target.
+
+        Targets in avoid are only used when no other server is left.
+        Returns (source, target); target is None when no chunk server can
+        take the copy and False when every candidate is at its stream limit.
+        """
+        with self.streams_lock:
+            free = [cs for cs in sources if self.streams_out.get(cs, 0) < self.source_streams]
+            busy = [cs for cs, n in self.streams_in.items() if n >= self.target_streams]
+            if not free:
+                return None, False
+            source = min(free, key=lambda cs: self.streams_out.get(cs, 0))
+            ignore = list(sources)
+            if avoid and self.ns._select_available_cs(ignore + list(avoid)) is not None:
+                ignore.extend(avoid)
+            target = self.ns._select_available_cs(ignore, busy)
+            if target is None:
+                if busy and self.ns._select_available_cs(ignore) is not None:
+                    return None, False
+                return None, None
+            self.streams_out[source] = self.streams_out.get(source, 0) + 1
+            self.streams_in[target] = self.streams_in.get(target, 0) + 1
+            return source, target
+
+    def _release_streams(self, source, target):
+        with self.streams_lock:
+            self.streams_out[source] -= 1
+            self.streams_in[target] -= 1
     
     #
     def create_dir(self, path):
@@ -298,7 +1419,7 @@ class Replicator:
         while i < len(dirs):
             d_name = dirs[i]
 
-            directory = next((x for x in curr_dir.children if x.name == d_name), None)
+            directory = curr_dir.children.get(d_name)
             if directory is None:
                 directory = FileNode(d_name, NodeType.directory)
                 curr_dir.add_child(directory)
@@ -311,48 +1432,127 @@ class Replicator:
 
         return curr_dir
 
-    def replicate(self, item):
-        if item is None:
+    def replicate(self, path):
+        if path is None:
             return
 
-        path = item[0]
-        cs_list = item[1]
+        with self.ns.lock.read():
+            info = self.ns.blocks.get(path)
+            cs_list = list(info.replicas) if info is not None else []
+            target = self.ns._replication_target(info.file) if info is not None else 0
+        if info is None:
+            print('Chunk', path, 'was deleted before replication')
+            return
 
         alive = [x for x in cs_list if self.ns._is_alive_cs(x)]
+        # copies on decommissioning servers still serve as sources
+        counted = [x for x in alive if x not in self.ns.decom]
 
         if len(alive) == 0:
-            print('There is no live CS for chunk', path)
+            if info.file.ec:
+                self.rebuild(path, info.file)
+            else:
+                print('There is no live CS for chunk', path)
             return
 
-        if len(alive) >= 2:
-            print('File', path, 'is already replicated to more than 2 nodes')
+        if len(counted) > target:
+            self.trim(path, counted[target:])
             return
 
-        new_cs = self.ns._select_available_cs(alive)
-        if new_cs is None:
+        if len(counted) == target:
+            return
+
+        # a new copy on a server still due to delete the old one would go too
+        avoid = self.ns.invalidations.holders(path)
+        if info.file.ec:
+            # a shard moving off a retired server must not join a sibling
+            with self.ns.lock.read():
+                for _, sibling in self.ns._ec_group(path, info.file)[1]:
+                    sibling_info = self.ns.blocks.get(sibling)
+                    if sibling_info is not None and sibling != path:
+                        avoid.extend(sibling_info.replicas)
+        source, new_cs = self._acquire_streams(alive, avoid)
+        if new_cs is False:
+            self._defer(path)
+        elif new_cs is None:
             print("Can't find available CS for replication", path)
         else:
             try:
-                cl = ServerProxy(alive[0])
-                cl.replicate_chunk(path, new_cs)
+                cl = ServerProxy(source)
+                res = cl.replicate_chunk(path, new_cs)
+                if res['status'] != Status.ok:
+                    print('Replication of', path, 'from', source, 'failed')
+                    self._defer(path)
+                    return
                 print("File", path, "replicated to", new_cs)
-
-                file = self.ns.root.find_file_by_chunk(path)
-                if file is not None and path in file.chunks:
-                    file.chunks[path].append(new_cs)
-                else:
-                    print("Can't find file for chunk", path, "after replication")
+                if len(counted) < len(alive):
+                    self.ns.decom.bucket.charge(res.get('size', 0))
+
+                with self.ns.lock.write():
+                    if self.ns.blocks.add_replica(path, new_cs):
+                        txid = self.ns._log_edit({'op': 'replica', 'c': path, 'a': new_cs})
+                    else:
+                        # already taken in from new_cs's block report, or deleted
+                        txid = None
+                        if self.ns.blocks.get(path) is None:
+                            print("Can't find file for chunk", path, "after replication")
+                self.ns._sync_edits(txid)
+                if len(counted) + 1 < target:
+                    self.put_in_queue(path)
             except Exception as e:
                 print('Error during replication', path, 'to', new_cs, ':', e)
+            finally:
+                self._release_streams(source, new_cs)
+
+    def rebuild(self, path, file):
+        """Decode a lost erasure-coded shard from its group onto a new server."""
+        k, m = file.ec[0], file.ec[1]
+        with self.ns.lock.read():
+            index, group = self.ns._ec_group(path, file)
+            holders = {}
+            for i, chunk_id in group:
+                info = self.ns.blocks.get(chunk_id)
+                if info is not None:
+                    holders[i] = [chunk_id, [cs for cs in info.replicas if self.ns._is_alive_cs(cs)]]
+        sources = [[i, chunk_id, servers[0]] for i, (chunk_id, servers) in holders.items() if servers]
+        if len(sources) < k:
+            print('Chunk group of', path, 'has', len(sources), 'shards left, needs', k)
+            return
 
-    def server_watcher(self):
-        while self.on:
-            for cs_name in list(self.ns.cs):
-                if not self.ns._is_alive_cs(cs_name):
-                    print('CS', cs_name, 'detected as not alive')
-                    self.ns.cs.pop(cs_name)
-                    _thread.start_new_thread(self.emergency_replication, ())
-            time.sleep(1)
+        # keep the group's shards on distinct servers while there are enough
+        target = self.ns._select_available_cs([cs for _, _, cs in sources])
+        if target is None:
+            target = self.ns._select_available_cs()
+            if target is None:
+                print("Can't find available CS to rebuild", path)
+                return
+            print('Not enough chunk servers to keep the shards of', path, 'apart')
+        try:
+            res = ServerProxy(target).reconstruct_chunk(path, sources, k, m, index)
+            if res['status'] != Status.ok:
+                print('Rebuild of', path, 'on', target, 'failed')
+                self._defer(path)
+                return
+            with self.ns.lock.write():
+                txid = None
+                if self.ns.blocks.add_replica(path, target):
+                    txid = self.ns._log_edit({'op': 'replica', 'c': path, 'a': target})
+            self.ns._sync_edits(txid)
+            print('Shard', path, 'rebuilt on', target)
+        except Exception as e:
+            print('Error during rebuild of', path, 'on', target, ':', e)
+
+    def trim(self, path, extra):
+        """Drop the replicas in extra after a chunk's factor was lowered."""
+        txid = None
+        with self.ns.lock.write():
+            for cs in extra:
+                if self.ns.blocks.remove_replica(path, cs):
+                    txid = self.ns._log_edit({'op': 'unreplica', 'c': path, 'a': cs})
+        self.ns._sync_edits(txid)
+        # forget the replicas before deleting them so no reader is sent there
+        self.ns.invalidations.add({path: extra}, delay=0)
+        print("Replicas of", path, "on", extra, "queued for removal")
 
 
     def remove_replica(self, data_node_address): #removes the replicas if needed.
@@ -361,9 +1561,14 @@ class Replicator:
                 self.data_nodes.remove(data_node_address)
                 print(f"Data Node {data_node_address} removed.")
 
-    def emergency_replication(self):
-        print('Start emergency replication for files from')
-        self.traverse_replication(self.ns.root)
+    def emergency_replication(self, cs_addr):
+        print('Start emergency replication for chunks from', cs_addr)
+        with self.ns.lock.read():
+            chunks = [(c, self.ns._live_replicas(self.ns.blocks.get(c)))
+                      for c in self.ns.blocks.chunks_on(cs_addr)]
+        for c, live in chunks:
+            self.queue.put(c, live)
+        print(len(chunks), 'chunks from', cs_addr, 'put to replication')
 
     def heartbeat(self, cs_addr): #
         if cs_addr not in self.cs:
@@ -372,41 +1577,394 @@ class Replicator:
         self.cs[cs_addr] = datetime.now()
         return {'status': Status.ok}
 
-    def traverse_replication(self, item):
-        if item.type == NodeType.file:
-            for c in list(item.chunks):
-                alive = [x for x in item.chunks[c] if self.ns._is_alive_cs(c)]
-                if len(alive) < 2:
-                    print('Chunk', c, 'put to replication')
-                    self.put_in_queue(c, item.chunks[c])
-        else:
-            for c in item.children:
-                self.traverse_replication(c)
+
+class TokenBucket:
+    """Byte budget refilled at rate bytes/s, holding at most burst.
+
+    Transfers wait() until the bucket isn't in debt and charge() their size
+    once it is known, so the average stays at rate whatever the chunk sizes.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 0:
+                    return
+                delay = -self.tokens / self.rate
+            time.sleep(delay)
+
+    def charge(self, n):
+        with self.lock:
+            self._refill()
+            self.tokens -= n
+
+
+class Balancer:
+    """Moves replicas from full chunk servers to empty ones.
+
+    Every interval seconds, servers whose disk utilization (used / total,
+    from heartbeats) is more than threshold above the mean give up chunks
+    to the servers below the mean until the excess bytes are moved. A move
+    copies the chunk with replicate_chunk, swaps the replica in the block
+    map and then deletes the source copy. At most max_moves run at once,
+    and together they are held to bandwidth bytes/s.
+    """
+
+    def __init__(self, ns, threshold=0.1, bandwidth=10 << 20, max_moves=4, interval=30):
+        self.ns = ns
+        self.threshold = threshold
+        self.bucket = TokenBucket(bandwidth)
+        self.moves = threading.BoundedSemaphore(max_moves)
+        self.interval = interval
+        self.moved = 0
+        self.on = True
+
+    def start(self):
+        _thread.start_new_thread(self._run, ())
+
+    def _run(self):
+        while self.on:
+            time.sleep(self.interval)
+            try:
+                self.balance()
+            except Exception as e:
+                print('Error while balancing:', e)
+
+    def utilization(self):
+        """Live chunk server -> (utilization, total bytes)."""
+        usage = {}
+        for cs in self.ns._cs_snapshot():
+            stats = self.ns.cs_stats.get(cs)
+            if not stats or not self.ns._is_alive_cs(cs) or cs in self.ns.decom:
+                continue
+            total = stats['used'] + stats['free']
+            if total > 0:
+                usage[cs] = (stats['used'] / total, total)
+        return usage
+
+    def balance(self):
+        """One balancing round; returns the number of chunks moved."""
+        usage = self.utilization()
+        if len(usage) < 2:
+            return 0
+        mean = sum(u for u, _ in usage.values()) / len(usage)
+        sources = sorted((cs for cs, (u, _) in usage.items() if u > mean + self.threshold),
+                         key=lambda cs: -usage[cs][0])
+        targets = [cs for cs, (u, _) in usage.items() if u < mean]
+        if not sources or not targets:
+            return 0
+
+        print('Balancing', len(sources), 'chunk servers above', round(mean + self.threshold, 3), 'utilization')
+        moved = 0
+        for src in sources:
+            excess = (usage[src][0] - mean) * usage[src][1]
+            with self.ns.lock.read():
+                chunk_ids = self.ns.blocks.chunks_on(src)
+            random.shuffle(chunk_ids)
+            done = []
+            sent = 0
+            threads = []
+            for chunk_id in chunk_ids:
+                if sent >= excess or not self.on:
+                    break
+                tgt = self._target(chunk_id, src, targets)
+                if tgt is None:
+                    continue
+                self.bucket.wait()
+                self.moves.acquire()
+                t = threading.Thread(target=self._move, args=(chunk_id, src, tgt, done))
+                t.start()
+                threads.append(t)
+                # sizes are only known once a move returns
+                sent = sum(done)
+            for t in threads:
+                t.join()
+            moved += len(done)
+        self.moved += moved
+        print('Balancer moved', moved, 'chunks')
+        return moved
+
+    def _target(self, chunk_id, src, targets):
+        """A target without a copy of chunk_id that keeps its racks apart."""
+        stats = self.ns.cs_stats
+        with self.ns.lock.read():
+            info = self.ns.blocks.get(chunk_id)
+            if info is None:
+                return None
+            replicas = list(info.replicas)
+            if info.file.ec:
+                # shards of one group must stay on distinct servers
+                for _, sibling in self.ns._ec_group(chunk_id, info.file)[1]:
+                    sibling_info = self.ns.blocks.get(sibling)
+                    if sibling_info is not None:
+                        replicas.extend(sibling_info.replicas)
+        racks = {stats.get(cs, {}).get('rack') for cs in replicas if cs != src} - {None, ''}
+        src_rack = stats.get(src, {}).get('rack')
+        candidates = [cs for cs in targets if cs not in replicas and
+                      (stats.get(cs, {}).get('rack') not in racks or stats.get(cs, {}).get('rack') == src_rack)]
+        if not candidates:
+            return None
+        return min(candidates, key=self.ns._cs_load)
+
+    def _move(self, chunk_id, src, tgt, done):
+        # until the swap, tgt's block report must not call its copy stale
+        self.ns.transfers.add((chunk_id, tgt))
+        try:
+            res = ServerProxy(src).replicate_chunk(chunk_id, tgt)
+            if res['status'] != Status.ok:
+                print('Balancer failed to copy', chunk_id, 'from', src, 'to', tgt)
+                return
+            self.bucket.charge(res['size'])
+
+            txid = None
+            drop = []
+            with self.ns.lock.write():
+                info = self.ns.blocks.get(chunk_id)
+                moved = info is not None and src in info.replicas and \
+                    self.ns.blocks.add_replica(chunk_id, tgt)
+                if moved:
+                    txid = self.ns._log_edit({'op': 'replica', 'c': chunk_id, 'a': tgt})
+                    self.ns.blocks.remove_replica(chunk_id, src)
+                    txid = self.ns._log_edit({'op': 'unreplica', 'c': chunk_id, 'a': src})
+                    drop = [src]
+                elif info is None or tgt not in info.replicas:
+                    # file deleted or src dropped meanwhile: the new copy goes
+                    drop = [tgt]
+                # else tgt was taken back as a replica already; keep both
+            self.ns._sync_edits(txid)
+
+            if drop:
+                self.ns.invalidations.add({chunk_id: drop}, delay=0)
+            if moved:
+                done.append(res['size'])
+                print('Balancer moved', chunk_id, 'from', src, 'to', tgt)
+        except Exception as e:
+            print('Balancer failed to move', chunk_id, 'from', src, 'to', tgt, ':', e)
+        finally:
+            self.ns.transfers.discard((chunk_id, tgt))
+            self.moves.release()
+
+
+class Decommissioner:
+    """Drains chunk servers that are being retired.
+
+    A decommissioning server keeps serving reads but gets no new chunks,
+    and its copies stop counting toward replication targets. Its chunks go
+    to the replication queue fewest other live copies first, while at most
+    window chunks are queued, and the copies made from them are held to
+    bandwidth bytes/s. Once every chunk on it meets its target elsewhere
+    the server is decommissioned: safe to shut down.
+    """
+
+    def __init__(self, ns, bandwidth=10 << 20, window=16, interval=5):
+        self.ns = ns
+        self.bucket = TokenBucket(bandwidth)
+        self.window = window
+        self.interval = interval
+        # chunk server -> {'state', 'started', 'chunks', 'remaining'}
+        self.nodes = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.on = True
+
+    def __contains__(self, cs):
+        return cs in self.nodes
+
+    def start(self):
+        _thread.start_new_thread(self._run, ())
+
+    def add(self, cs):
+        with self.lock:
+            if cs in self.nodes:
+                return False
+            self.nodes[cs] = {'state': 'decommissioning', 'started': time.time(), 'chunks': 0, 'remaining': 0}
+        print('Decommissioning chunk server', cs)
+        self.wake.set()
+        return True
+
+    def remove(self, cs):
+        with self.lock:
+            return self.nodes.pop(cs, None) is not None
+
+    def progress(self, cs=None):
+        with self.lock:
+            return {addr: dict(node) for addr, node in self.nodes.items() if cs in (None, addr)}
+
+    def _run(self):
+        while self.on:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            with self.lock:
+                draining = [cs for cs, node in self.nodes.items() if node['state'] == 'decommissioning']
+            for cs in draining:
+                try:
+                    self.drain(cs)
+                except Exception as e:
+                    print('Error while draining', cs, ':', e)
+
+    def _pending(self, cs):
+        """Chunks on cs short of their target without it, most endangered first."""
+        pending = []
+        with self.ns.lock.read():
+            chunk_ids = self.ns.blocks.chunks_on(cs)
+            for chunk_id in chunk_ids:
+                info = self.ns.blocks.get(chunk_id)
+                live = self.ns._live_replicas(info)
+                if live < self.ns._replication_target(info.file):
+                    pending.append((live, chunk_id))
+        pending.sort()
+        return len(chunk_ids), pending
+
+    def drain(self, cs):
+        """One pass over cs; returns the number of chunks still to copy."""
+        total, pending = self._pending(cs)
+        with self.lock:
+            node = self.nodes.get(cs)
+            if node is None:
+                return 0
+            node['chunks'] = total
+            node['remaining'] = len(pending)
+            if not pending:
+                node['state'] = 'decommissioned'
+                print('Chunk server', cs, 'is decommissioned and safe to remove')
+                return 0
+
+        queue = self.ns.repl.queue
+        for live, chunk_id in pending:
+            if not self.on or cs not in self.nodes:
+                break
+            while len(queue) >= self.window and self.on:
+                time.sleep(0.1)
+            self.bucket.wait()
+            queue.put(chunk_id, live)
+        return len(pending)
 
 
 class NameNode:
-    def __init__(self, dump_on=True, dump_path="./metadata.yml", cs_timeout=2):
+    # dump file of name servers from before the binary image
+    LEGACY_DUMP = 'metadata.yml'
+
+    def __init__(self, dump_on=True, dump_path="./metadata.img", cs_timeout=2, path_cache_size=100000,
+                 checkpoint_ops=10000, checkpoint_period=300, replication_workers=4, default_replication=2,
+                 orphan_grace=300, min_free=1 << 30, balance_threshold=0.1, balance_bandwidth=10 << 20,
+                 trash_delay=0, decommission_bandwidth=10 << 20):
         self.root = FileNode('/', NodeType.directory)
         self.dump_on = dump_on
         self.dump_path = dump_path
         self.cs_timeout = cs_timeout
-        self.cs = {}
-        self.repl = Replicator(self)
+        # replication factor of files with none set on them or their parents
+        self.default_replication = default_replication
+        # chunk servers with less free disk only get writes when all do
+        self.min_free = min_free
+        # last stats each chunk server sent with its heartbeat
+        self.cs_stats = {}
+        # (chunk id, target) of copies being moved by the balancer
+        self.transfers = set()
+        # unknown chunks younger than this may belong to an upload whose
+        # create_file hasn't arrived yet, so block reports leave them alone
+        self.orphan_grace = orphan_grace
+        # heartbeat deadlines; a missed one fires handle_chunk_server_failures
+        self.cs = HeartbeatTracker(cs_timeout, self.handle_chunk_server_failures)
+        self.path_cache = PathCache(path_cache_size)
+        # chunk copies to delete, handed to chunk servers with heartbeat replies
+        self.invalidations = InvalidationQueue(delay=trash_delay)
+        self.blocks = BlockMap(self.invalidations)
+        # block reports from heartbeats, reconciled off the RPC threads
+        self.reports = BlockReportQueue(self._process_report)
+        self.index = NamespaceIndex()
+        # namespace lock: readers share it, mutations and checkpoints are serialized
+        self.lock = RWLock()
+        self.edit_log = EditLog(dump_path + '.edits')
+        self.checkpoint_ops = checkpoint_ops
+        self.checkpoint_period = checkpoint_period
+        self.ops_since_checkpoint = 0
+        self.checkpoint_needed = threading.Event()
+        self.on = True
+        self.repl = Replicator(self, workers=replication_workers)
+        self.balancer = Balancer(self, threshold=balance_threshold, bandwidth=balance_bandwidth)
+        # chunk servers being retired; they take no new chunks
+        self.decom = Decommissioner(self, bandwidth=decommission_bandwidth)
 
     def start(self):
         self._load_dump()
+        if self.dump_on:
+            _thread.start_new_thread(self._checkpointer, ())
+        _thread.start_new_thread(self.cs.run, ())
+        _thread.start_new_thread(self.reports.run, ())
         self.repl.start()
-
+        self.balancer.start()
+        self.decom.start()
+
+    def stop(self):
+        self.on = False
+        self.cs.on = False
+        self.reports.on = False
+        self.repl.on = False
+        self.balancer.on = False
+        self.decom.on = False
+        if self.dump_on and self.edit_log.f is not None:
+            self.checkpoint()
+            self.edit_log.close()
+
+
+    def _dump_source(self):
+        """The dump to load: dump_path, else a YAML dump an older name server
+        left beside it, whose edit log is then carried over. Starting empty
+        next to one would make every stored chunk an orphan."""
+        if os.path.isfile(self.dump_path):
+            return self.dump_path
+        legacy = os.path.join(os.path.dirname(self.dump_path), self.LEGACY_DUMP)
+        if os.path.abspath(legacy) == os.path.abspath(self.dump_path) or not os.path.isfile(legacy):
+            return None
+        print("No dump file at", self.dump_path, "but found the legacy dump", legacy)
+        if self.dump_on:
+            # the first checkpoint writes dump_path; the legacy files are left alone
+            for suffix in ('.edits.prev', '.edits'):
+                if os.path.isfile(legacy + suffix) and not os.path.exists(self.dump_path + suffix):
+                    shutil.copyfile(legacy + suffix, self.dump_path + suffix)
+        return legacy
 
     def _load_dump(self):
-        if os.path.isfile(self.dump_path):
-            print("Trying to read the file tree from the dump file", self.dump_path)
-            with open(self.dump_path) as f:
-                self.root = yaml.load(f,Loader=yaml.Loader)
+        txid = 0
+        source = self._dump_source()
+        if source is not None:
+            print("Trying to read the file tree from the dump file", source)
+            if FsImage.is_image(source):
+                self.root, txid = FsImage.load(source)
+            else:
+                self.root, txid = FsImage.load_yaml(source)
+            self.path_cache.clear()
+            self.blocks.rebuild(self.root)
+            self.index.rebuild(self.root)
             print("File tree has been loaded from the dump file")
         else:
             print("No dump file detected")
 
+        if not self.dump_on:
+            return
+
+        replayed = 0
+        for op in self.edit_log.read(txid):
+            self._apply_edit(op)
+            txid = op['t']
+            replayed += 1
+        if replayed:
+            print("Replayed", replayed, "edits from", self.edit_log.path)
+        self.edit_log.open(txid)
+
     def load_metadata(self):
         try:
             with open(self.metadata_path, 'r') as file:
@@ -419,17 +1977,153 @@ class NameNode:
             # Handle the case when the file is not found or not valid JSON
             self.metadata = {}    
 
-    def _dump(self):
-        if self.dump_on:
-            try:
-                with open(self.dump_path, 'w') as outfile:
-                    outfile.write(yaml.dump(self.root))
-            except Exception as e:
-                print("Error dumping file", self.dump_path, e)
+    def _dump(self, image):
+        tmp_path = self.dump_path + '.tmp'
+        with open(tmp_path, 'wb') as outfile:
+            outfile.write(image)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, self.dump_path)
+
+    def checkpoint(self):
+        """Merge the edit log into a fresh image of the tree."""
+        try:
+            with self.lock.read():
+                txid = self.edit_log.roll()
+                image = FsImage.dumps(self.root, txid)
+                self.ops_since_checkpoint = 0
+            self._dump(image)
+            self.edit_log.purge_prev()
+            print("Checkpoint written at txid", txid)
+        except Exception as e:
+            print("Error writing checkpoint", self.dump_path, e)
+
+    def _checkpointer(self):
+        while self.on:
+            self.checkpoint_needed.wait(self.checkpoint_period)
+            self.checkpoint_needed.clear()
+            if self.on and self.ops_since_checkpoint > 0:
+                self.checkpoint()
+
+    def _log_edit(self, op):
+        # caller holds the write lock so the log order matches the tree order
+        if not self.dump_on:
+            return None
+        txid = self.edit_log.append(op)
+        self.ops_since_checkpoint += 1
+        if self.ops_since_checkpoint >= self.checkpoint_ops:
+            self.checkpoint_needed.set()
+        return txid
+
+    def _sync_edits(self, txid):
+        if txid is not None:
+            self.edit_log.sync(txid)
+
+    def _apply_edit(self, op):
+        kind = op['op']
+        if kind == 'mkdir':
+            if self._lookup(op['p']) is None:
+                self._add_dir(op['p'])
+        elif kind == 'create':
+            if self._lookup(op['p']) is None:
+                self._add_file(op['p'], op['s'], op['c'], op['d'], op.get('e'), op.get('z'))
+        elif kind == 'ec':
+            file = self._lookup(op['p'])
+            if file is not None:
+                self._set_ec(file, op['s'], op['c'], op['e'])
+        elif kind == 'delete':
+            item = self._lookup(op['p'])
+            if item is not None and not item.is_root:
+                self._remove(op['p'], item)
+        elif kind == 'replica':
+            self.blocks.add_replica(op['c'], op['a'])
+        elif kind == 'unreplica':
+            self.blocks.remove_replica(op['c'], op['a'])
+        elif kind == 'setrep':
+            item = self._lookup(op['p'])
+            if item is not None:
+                item.replication = op['r']
+        else:
+            print("Unknown edit log record", op)
+
+    # Tree mutations shared by the RPCs and edit log replay. They keep the
+    # path cache, block map and search index in step with the tree; callers
+    # hold the write lock.
+
+    def _add_file(self, path, size, chunks, date=None, ec=None, sizes=None):
+        file = self.root.create_file(path)
+        if file == "Error":
+            return file
+        if date is not None:
+            file.date = date
+        file.ec = ec
+        file.size = size
+        for chunk_id, replicas in chunks.items():
+            file.add_chunk(chunk_id, replicas)
+        if sizes:
+            file.chunk_sizes = {c: int(n) for c, n in sizes.items() if c in file.chunks}
+        key = self._normalize_path(path)
+        self.path_cache.invalidate(key)
+        self.blocks.add_file(file)
+        self.index.add(key, file)
+        return file
+
+    def _set_ec(self, file, size, chunks, ec):
+        """Swap a file's chunks for erasure-coded shards; returns the old ones."""
+        old = self.blocks.remove_tree(file)
+        file.clear_chunks()
+        file.ec = ec
+        file.size = size
+        for chunk_id, replicas in chunks.items():
+            file.add_chunk(chunk_id, replicas)
+        self.blocks.add_file(file)
+        return old
+
+    def _add_dir(self, path):
+        d = self.root.create_dir(path)
+        if d != "Error":
+            key = self._normalize_path(path)
+            self.path_cache.invalidate(key)
+            self.index.add(key, d)
+        return d
+
+    def _remove(self, path, item):
+        """Detach item; returns chunk id -> replicas for everything under it."""
+        item.delete()
+        key = self._normalize_path(path)
+        self.path_cache.invalidate(key, recursive=item.type == NodeType.directory)
+        self.index.remove(key, item)
+        return self.blocks.remove_tree(item)
+
+    @staticmethod
+    def _normalize_path(path):
+        return '/' + path.strip('/')
+
+    def _lookup(self, path):
+        key = self._normalize_path(path)
+        node = self.path_cache.get(key)
+        if node is None:
+            node = self.root.find_path(key)
+            if node is not None:
+                self.path_cache.put(key, node)
+        return node
+
+    def get_cs_many(self, paths):
+        with self.lock.read():
+            exists = [self._lookup(p) is not None for p in paths]
+        results = []
+        for e in exists:
+            if e:
+                results.append({'status': Status.already_exists})
+                continue
+            cs = self._select_available_cs()
+            results.append({'status': Status.not_found} if cs is None else {'status': Status.ok, 'cs': cs})
+        return {'status': Status.ok, 'items': results}
 
     def get_cs(self, path):
-        if self.root.find_path(path) is not None:
-            print(self.root.find_path(path))
+        with self.lock.read():
+            exists = self._lookup(path) is not None
+        if exists:
             return {'status': Status.already_exists}
         
         cs = self._select_available_cs()
@@ -439,10 +2133,47 @@ class NameNode:
 
         return {'status': Status.ok, 'cs': cs}
 
+    def get_cs_group(self, count):
+        """count distinct chunk servers for the shards of an erasure-coded group."""
+        group = []
+        for _ in range(count):
+            cs = self._select_available_cs(group)
+            if cs is None:
+                print("Only", len(group), "of", count, "chunk servers available")
+                return {'status': Status.not_found}
+            group.append(cs)
+        return {'status': Status.ok, 'cs': group}
+
+    def convert_to_ec(self, data):
+        """Replace a file's replicated chunks with erasure-coded shards.
+
+        The client has already written the shards; data holds 'path', 'size',
+        'ec' ([k, m, shard size]) and 'chunks' (shard id -> chunk server).
+        """
+        with self.lock.write():
+            file = self._lookup(data['path'])
+            if file is None:
+                return {'status': Status.not_found}
+            if file.type != NodeType.file:
+                return {'status': Status.error}
+            chunks = {c: [cs] for c, cs in data['chunks'].items()}
+            old = self._set_ec(file, data['size'], chunks, data['ec'])
+            txid = self._log_edit({'op': 'ec', 'p': data['path'], 's': file.size,
+                                   'c': file.chunks, 'e': file.ec})
+        self._sync_edits(txid)
+        # shard ids repeat when an EC file is converted again; a rewritten
+        # shard that moved to another server leaves its old copy behind
+        old = {c: [cs for cs in servers if cs not in file.chunks.get(c, ())] for c, servers in old.items()}
+        old = {c: servers for c, servers in old.items() if servers}
+        if old:
+            self.delete_from_chunk_servers(old)
+        print('Converted', data['path'], 'to RS(%d,%d)' % (file.ec[0], file.ec[1]))
+        return {'status': Status.ok}
+
     def get_chunk_server_status(self):
         chunk_server_status = {}
     # Collect health metrics, load metrics, storage utilization, and network performance for each chunk server. returns json instead of yml format. so don't use
-        for cs_addr in self.cs:
+        for cs_addr in self._cs_snapshot():
             try:
                 cl = ServerProxy(cs_addr)
                 status = cl.get_status()
@@ -456,139 +2187,393 @@ class NameNode:
 
         return {'status': Status.ok, 'chunk_server_status': chunk_server_status}
 
-    def _select_available_cs(self, ignore_cs=None):
+    def _cs_load(self, cs_addr):
+        stats = self.cs_stats.get(cs_addr, {})
+        return (stats.get('reads', 0) + stats.get('writes', 0) + stats.get('queue', 0),
+                stats.get('latency', 0.0))
+
+    def _select_available_cs(self, ignore_cs=None, busy=()):
+        """Pick a chunk server for a new chunk or replica.
+
+        Decommissioning servers and those below min_free bytes are skipped,
+        and those on a rack that
+        already holds one of ignore_cs (the chunk's replicas) are only used
+        when no other rack is left. Of two random candidates the less loaded
+        one wins, by active transfers plus queued requests, then latency.
+        Servers in busy are skipped after the rack choice, so a busy server
+        on a free rack means None rather than a copy on a used rack.
+        """
         if ignore_cs is None:
             ignore_cs = []
 
-        live = [cs_name for cs_name in self.cs if self._is_alive_cs(cs_name) and cs_name not in ignore_cs]
+        live = [cs_name for cs_name in self._cs_snapshot()
+                if self._is_alive_cs(cs_name) and cs_name not in ignore_cs and cs_name not in self.decom]
+        stats = self.cs_stats
+        roomy = [cs_name for cs_name in live if stats.get(cs_name, {}).get('free', self.min_free) >= self.min_free]
+        if roomy:
+            live = roomy
+        elif live:
+            print('Every chunk server is below', self.min_free, 'bytes free')
+
+        used_racks = {stats[cs]['rack'] for cs in ignore_cs if stats.get(cs, {}).get('rack')}
+        if used_racks:
+            other_racks = [cs_name for cs_name in live if stats.get(cs_name, {}).get('rack') not in used_racks]
+            if other_racks:
+                live = other_racks
+        live = [cs_name for cs_name in live if cs_name not in busy]
 
         if len(live) == 0:
             return None
+        if len(live) == 1:
+            return live[0]
+
+        a, b = random.sample(live, 2)
+        return a if self._cs_load(a) <= self._cs_load(b) else b
+
+    def search_files(self, query):
+        """Find paths matching every given field of query.
+
+        pattern      glob over whole paths, '*' never crosses '/'
+                     (/logs/2026-*/part-*.gz)
+        prefix       only paths below this directory
+        name, ext    exact file name or extension ('.gz')
+        type         NodeType.file or NodeType.directory
+        min_size, max_size, modified_after, modified_before
+
+        Results come back in path order, limit at a time (default 1000);
+        pass 'next' from the reply as start_after to get the next page.
+        """
+        pattern = query.get('pattern', '')
+        prefix = query.get('prefix', '/')
+        start_after = query.get('start_after', '')
+        limit = query.get('limit', 1000)
+
+        # scan only the sorted range below the pattern's literal directories
+        scan_prefix = prefix
+        segments = None
+        if pattern:
+            segments = ('/' + pattern.strip('/')).split('/')
+            literal = []
+            for seg in segments[1:-1]:
+                if any(ch in seg for ch in '*?['):
+                    break
+                literal.append(seg)
+            if literal and len('/' + '/'.join(literal)) > len(prefix.rstrip('/')):
+                scan_prefix = '/' + '/'.join(literal)
+
+        with self.lock.read():
+            index = self.index
+            if query.get('name'):
+                candidates = index.keyed(index.by_name, query['name'], start_after)
+            elif query.get('ext'):
+                ext = query['ext'].lower()
+                if not ext.startswith('.'):
+                    ext = '.' + ext
+                candidates = index.keyed(index.by_ext, ext, start_after)
+            else:
+                candidates = index.under(scan_prefix, start_after)
+
+            base = prefix.rstrip('/') + '/'
+            items = []
+            next_path = ''
+            for path in candidates:
+                if not path.startswith(base):
+                    continue
+                if segments is not None:
+                    parts = path.split('/')
+                    if len(parts) != len(segments) or not all(
+                            fnmatch.fnmatchcase(part, seg) for part, seg in zip(parts, segments)):
+                        continue
+                node = index.nodes.get(path)
+                if node is None or not self._matches(node, query):
+                    continue
+                if limit > 0 and len(items) == limit:
+                    next_path = items[-1]['path']
+                    break
+                items.append({'path': path, 'type': node.type, 'size': node.size, 'date': node.date})
 
-        i = random.randint(0, len(live) - 1)
-        return live[i]
+        return {'status': Status.ok, 'items': items, 'next': next_path}
 
-    def search_files(self, query): 
-        search_results = []
+    @staticmethod
+    def _matches(node, query):
+        if 'type' in query and node.type != query['type']:
+            return False
+        if 'min_size' in query and node.size < query['min_size']:
+            return False
+        if 'max_size' in query and node.size > query['max_size']:
+            return False
+        if 'modified_after' in query and node.date < query['modified_after']:
+            return False
+        if 'modified_before' in query and node.date > query['modified_before']:
+            return False
+        return True
 
-        for file in self.root.get_all_files():
-            if matches_query(file, query):
-                search_results.append(file)
-        #this has been implemented as ls. use ls instead
-        return {'status': Status.ok, 'search_results': search_results}
+    def _cs_snapshot(self):
+        return self.cs.snapshot()
 
     def _is_alive_cs(self, cs_addr):
-        if cs_addr not in self.cs:
-            return False
+        return self.cs.is_alive(cs_addr)
 
-        last_hb = self.cs[cs_addr]
-        now = datetime.now()
-        diff = (now - last_hb).total_seconds()
-        return diff <= self.cs_timeout
+    def _live_replicas(self, info):
+        """Replicas that count toward the target: live and not being retired."""
+        return sum(1 for cs in info.replicas if self._is_alive_cs(cs) and cs not in self.decom)
 
     def create_file(self, data):
-        file = self.root.find_path(data['path'])
-        print(file)
-        if file is not None:
-            return {'status': Status.already_exists}
-
-        file = self.root.create_file(data['path'])
-        if file == "Error":
-            return {'status': Status.error}
+        return self.create_files([data])['items'][0]
+
+    def create_files(self, files):
+        """Create many files with one edit log sync; per-file status in 'items'."""
+        results = []
+        created = []
+        txid = None
+        with self.lock.write():
+            for data in files:
+                file = self._lookup(data['path'])
+                if file is not None:
+                    results.append({'status': Status.already_exists})
+                    continue
 
-        file.size = data['size']
-        for k, v in data['chunks'].items():
-            file.chunks[k] = [v]
-            print('Chunk', k, 'saved on', v)
+                chunks = {}
+                for k, v in data['chunks'].items():
+                    chunks[k] = [v]
+                file = self._add_file(data['path'], data['size'], chunks, ec=data.get('ec'),
+                                      sizes=data.get('sizes'))
+                if file == "Error":
+                    results.append({'status': Status.error})
+                    continue
 
-        for c in file.chunks:
-            self.repl.put_in_queue(c, file.chunks[c])
+                op = {'op': 'create', 'p': data['path'], 's': file.size, 'c': file.chunks, 'd': file.date}
+                if file.ec:
+                    op['e'] = file.ec
+                if file.chunk_sizes:
+                    op['z'] = file.chunk_sizes
+                txid = self._log_edit(op)
+                created.append(file)
+                results.append({'status': Status.ok})
 
-        self._dump()
-        print("Created file " + data['path'] + ' of size ' + str(data['size']))
+        self._sync_edits(txid)
+        for file in created:
+            for c in file.chunks:
+                self.repl.put_in_queue(c)
 
-        return {'status': Status.ok}
+        print("Created", len(created), "of", len(files), "files")
+        return {'status': Status.ok, 'items': results}
 
-    #shreya's version
     def handle_chunk_server_failures(self, cs_addr):
         try:
             print('Handling failure of chunk server', cs_addr)
-            failed_cs = self.cs.pop(cs_addr)
-
-            for chunk_path, servers in failed_cs.items():
-                if len(servers) > 1:
-                    print('Replicating chunk', chunk_path, 'to remaining servers:', servers[1:])
-                else:
-                    new_cs = self._select_available_cs()
-                    print('Replicating chunk', chunk_path, 'to new server', new_cs)
-
-            print('Notifying administrators of chunk server failure:', cs_addr)
-            self.cs.pop(cs_addr)
-
+            self.cs.forget(cs_addr)
+            self.repl.emergency_replication(cs_addr)
+            return True
         except Exception as e:
             print("Error handling chunk server failure:", e)
             return False
 
+    def report_bad_chunks(self, cs_addr, chunk_ids):
+        """cs_addr found its copies of chunk_ids failing their checksums.
+
+        A corrupt copy stops counting as a replica and is deleted, and the
+        chunk is queued to be copied or, erasure-coded, rebuilt from healthy
+        ones. The last listed copy of a replicated chunk is kept: a partly
+        readable chunk beats none.
+        """
+        bad = {}
+        txid = None
+        with self.lock.write():
+            for reported_id in chunk_ids:
+                chunk_id = self._reported_chunk(reported_id)
+                info = self.blocks.get(chunk_id) if chunk_id is not None else None
+                if info is None or cs_addr not in info.replicas:
+                    continue
+                if len(info.replicas) == 1 and not info.file.ec:
+                    print('The only copy of', chunk_id, 'on', cs_addr, 'is corrupt')
+                    continue
+                self.blocks.remove_replica(chunk_id, cs_addr)
+                txid = self._log_edit({'op': 'unreplica', 'c': chunk_id, 'a': cs_addr})
+                bad[chunk_id] = [cs_addr]
+        self._sync_edits(txid)
+        if bad:
+            print('Corrupt copies reported by', cs_addr, ':', ', '.join(bad))
+            self.invalidations.add(bad, delay=0)
+            for chunk_id in bad:
+                self.repl.put_in_queue(chunk_id)
+        return {'status': Status.ok, 'removed': len(bad)}
+
+    def decommission(self, cs_addr):
+        """Start draining cs_addr; see decommission_status for progress."""
+        if cs_addr not in self.cs and cs_addr not in self.blocks.servers:
+            return {'status': Status.not_found}
+        if not self.decom.add(cs_addr):
+            return {'status': Status.already_exists}
+        return {'status': Status.ok}
+
+    def recommission(self, cs_addr):
+        """Put a decommissioning or decommissioned server back in service."""
+        if not self.decom.remove(cs_addr):
+            return {'status': Status.not_found}
+        print('Chunk server', cs_addr, 'is back in service')
+        # its copies count again, so chunks copied off it are over target
+        with self.lock.read():
+            chunk_ids = self.blocks.chunks_on(cs_addr)
+        for c in chunk_ids:
+            self.repl.put_in_queue(c)
+        return {'status': Status.ok}
+
+    def decommission_status(self, cs_addr=''):
+        """Progress of every retired server, or of cs_addr.
+
+        'nodes' maps a server to its 'state' ('decommissioning' or
+        'decommissioned', which is safe to remove), when it 'started', the
+        'chunks' it holds and how many are 'remaining' to copy elsewhere.
+        """
+        nodes = self.decom.progress(cs_addr or None)
+        if cs_addr and not nodes:
+            return {'status': Status.not_found}
+        return {'status': Status.ok, 'nodes': nodes}
+
     def delete(self, path):
         print("Delete", path)
-        item = self.root.find_path(path)
-        if item is None:
-            return {'status': Status.not_found}
+        return self.delete_many([path])['items'][0]
 
-        if item.is_root:
-            return {'status': Status.error}
+    def delete_many(self, paths):
+        results = []
+        chunks = {}
+        txid = None
+        with self.lock.write():
+            for path in paths:
+                item = self._lookup(path)
+                if item is None:
+                    results.append({'status': Status.not_found})
+                    continue
 
-        item.delete()
-        self._dump()
-        _thread.start_new_thread(self.delete_from_chunk_servers, (item,))
-        return {'status': Status.ok}
+                if item.is_root:
+                    results.append({'status': Status.error})
+                    continue
 
-    def delete_from_chunk_servers(self, file):
-        if file.type == NodeType.directory:
-            for c in list(file.children):
-                self.delete_from_chunk_servers(c)
-        else:
-            print('Start delete file', file.get_full_path())
-            for f_path, servers in file.chunks.items():
-                for cs in servers:
-                    try:
-                        cl = ServerProxy(cs)
-                        print('Send delete', f_path, 'to', cs)
-                        cl.delete_chunk(f_path)
-                    except:
-                        print('Failed to delete', f_path, 'from', cs)
+                chunks.update(self._remove(path, item))
+                txid = self._log_edit({'op': 'delete', 'p': path})
+                results.append({'status': Status.ok})
 
+        self._sync_edits(txid)
+        if chunks:
+            self.delete_from_chunk_servers(chunks)
+        return {'status': Status.ok, 'items': results}
+
+    def delete_from_chunk_servers(self, chunks):
+        """Queue chunk id -> chunk servers for deletion.
+
+        The ids go out in batches with the servers' heartbeat replies, after
+        the trash delay, and are resent until a block report confirms them.
+        """
+        self.invalidations.add(chunks)
+        print('Queued', len(chunks), 'chunks for deletion')
+
+    def setrep(self, path, replication):
+        """Set the replication factor of a file or directory tree.
+
+        Files and directories below path without a factor of their own
+        inherit it. 0 clears the factor so path inherits from its parent.
+        """
+        if not 0 <= replication <= 255:
+            return {'status': Status.error}
+        with self.lock.write():
+            item = self._lookup(path)
+            if item is None:
+                return {'status': Status.not_found}
+            item.replication = replication or None
+            txid = self._log_edit({'op': 'setrep', 'p': path, 'r': item.replication})
+            chunk_ids = []
+            stack = [item]
+            while stack:
+                node = stack.pop()
+                chunk_ids.extend(node.chunks)
+                stack.extend(node.children.values())
+
+        self._sync_edits(txid)
+        for c in chunk_ids:
+            self.repl.put_in_queue(c)
+        return {'status': Status.ok, 'replication': item.effective_replication(self.default_replication),
+                'chunks': len(chunk_ids)}
 
     def get_random_data_node(self):
         return next(iter(self.data_nodes)) # self.data_nodes.status == Status.ok
 
     def get_file_info(self, path):
-        file = self.root.find_path(path)
-        if file is None:
-            return {'status': Status.not_found}
+        with self.lock.read():
+            file = self._lookup(path)
+            if file is None:
+                return {'status': Status.not_found}
+            return self._file_info(file)
+
+    def get_file_info_many(self, paths, include_chunks=True):
+        with self.lock.read():
+            items = []
+            for path in paths:
+                file = self._lookup(path)
+                if file is None:
+                    items.append({'status': Status.not_found})
+                else:
+                    items.append(self._file_info(file, self._normalize_path(path), include_chunks))
+        return {'status': Status.ok, 'items': items}
 
+    def _file_info(self, file, path=None, include_chunks=True):
         chunks = {}
-        for c_path, val in file.chunks.items():
-            chunks[c_path] = val[0]
-
-        return {'status': Status.ok,
+        sizes = {}
+        if include_chunks:
+            for c_path, val in file.chunks.items():
+                # hand out a live replica when there is one
+                chunks[c_path] = next((cs for cs in val if self._is_alive_cs(cs)), val[0] if val else '')
+            sizes = file.chunk_sizes
+
+        info = {'status': Status.ok,
                 'type': file.type,
-                'path': file.get_full_path(),
+                'path': file.get_full_path() if path is None else path,
                 'size': file.size,
                 'date': file.date,
+                'replication': self._replication_target(file),
                 'chunks': chunks}
+        if sizes:
+            info['sizes'] = sizes
+        if file.ec:
+            info['ec'] = file.ec
+        return info
+
+    def _replication_target(self, file):
+        # erasure-coded shards are stored once; parity stands in for copies
+        if file.ec:
+            return 1
+        return file.effective_replication(self.default_replication)
+
+    @staticmethod
+    def _ec_group(chunk_id, file):
+        """Shard index of chunk_id and [index, id] of every shard in its group."""
+        base, index = chunk_id.rsplit('_', 1)
+        k, m = file.ec[0], file.ec[1]
+        return int(index), [[i, '%s_%d' % (base, i)] for i in range(k + m)]
 
     def make_directory(self, path):
-        d = self.root.find_path(path)
+        return self.make_directories([path])['items'][0]
 
-        if d is not None:
-            return {'status': Status.already_exists}
+    def make_directories(self, paths):
+        results = []
+        txid = None
+        with self.lock.write():
+            for path in paths:
+                d = self._lookup(path)
 
-        d = self.root.create_dir(path)
-        if d == "Error":
-            return {'status': Status.error}
+                if d is not None:
+                    results.append({'status': Status.already_exists})
+                    continue
 
-        return {'status': Status.ok}
+                d = self._add_dir(path)
+                if d == "Error":
+                    results.append({'status': Status.error})
+                    continue
+                txid = self._log_edit({'op': 'mkdir', 'p': path})
+                results.append({'status': Status.ok})
+
+        self._sync_edits(txid)
+        return {'status': Status.ok, 'items': results}
 
     def resolve_namespace(self, path):
         # Implement logic to resolve file/directory path to physical location
@@ -604,29 +2589,40 @@ class NameNode:
             print(f"Error pinging Data Node {data_node_address}: {e}")
             return False
 
-    def list_directory(self, path):
-        print('Request to list directory ' + path)
-        directory = self.root.find_path(path)
-        if directory is None:
-            return {'status': Status.not_found}
+    def list_directory(self, path, start_after='', limit=0, include_chunks=True):
+        """List children in name order, limit at a time (0 = all).
+
+        'next' in the result is the start_after for the following page, or
+        '' once the listing is complete.
+        """
+        with self.lock.read():
+            directory = self._lookup(path)
+            if directory is None:
+                return {'status': Status.not_found}
+
+            names = directory.sorted_child_names()
+            start = bisect.bisect_right(names, start_after) if start_after else 0
+            end = len(names) if limit <= 0 else min(len(names), start + limit)
+            base = self._normalize_path(path).rstrip('/')
 
-        items = {}
-        for f in directory.children:
-            items[f.name] = self.get_file_info(f.get_full_path())
+            items = {}
+            for name in names[start:end]:
+                items[name] = self._file_info(directory.children[name], base + '/' + name, include_chunks)
 
-        result = {'status': Status.ok, 'items': items}
-        return result
+            next_name = names[end - 1] if end < len(names) else ''
+
+        return {'status': Status.ok, 'items': items, 'next': next_name}
 
 
     def validate_chunk_servers(self):
     # This function attempts to validate the health of chunk servers by checking their status and resource availability.
         try:
-            for cs_addr in self.cs:
+            for cs_addr in self._cs_snapshot():
                 cl = ServerProxy(cs_addr)
                 status = cl.get_status()
                 if status['status'] != Status.ok:
                     print('Chunk server', cs_addr, 'is not healthy:', status)
-                    self.cs.pop(cs_addr)
+                    self.cs.forget(cs_addr)
                     continue
                 resources = cl.get_resources()
                 if resources['cpu'] < 20 or resources['memory'] < 50 or resources['storage'] < 100:
@@ -637,30 +2633,145 @@ class NameNode:
             return False
 
     def size_of(self, path):
-        i = self.root.find_path(path)
-        if i is None:
-            return {'status': Status.not_found, 'size': 0}
-
-        return {'status': Status.ok, 'size': i.size}
-        
-    def heartbeat(self, cs_addr):
-        if cs_addr not in self.cs:
+        with self.lock.read():
+            i = self._lookup(path)
+            if i is None:
+                return {'status': Status.not_found, 'size': 0}
+
+            return {'status': Status.ok, 'size': i.size, 'files': i.file_count, 'chunks': i.chunk_count}
+
+    def heartbeat(self, cs_addr, report=None, stats=None):
+        """Record a heartbeat and reconcile the block report it carries.
+
+        stats is the server's load: disk 'free' and 'used' bytes, active
+        'reads' and 'writes', 'queue' (requests waiting for a worker),
+        'latency' (moving average in seconds) and an optional 'rack'.
+
+        report is {'full': [[chunk_id, mtime], ...]} with everything the
+        chunk server stores, or {'added': [[chunk_id, mtime], ...],
+        'deleted': [chunk_id, ...]} with the changes since its last
+        heartbeat. The report is queued for the report thread, so no
+        heartbeat waits for the namespace lock. Chunks the server should
+        remove come back in 'delete': orphans and stale copies found in its
+        earlier reports followed by a batch of pending invalidations;
+        'full_report' asks for a full report with the next heartbeat.
+        """
+        new = self.cs.beat(cs_addr)
+        if new:
             print('Register CS ' + cs_addr)
+        if stats:
+            self.cs_stats[cs_addr] = stats
+        reply = {'status': Status.ok}
+        if report:
+            self.reports.put(cs_addr, report)
+        delete = self.reports.take(cs_addr)
+        delete.extend(self.invalidations.take(cs_addr))
+        if delete:
+            reply['delete'] = delete
+        if new and not (report and 'full' in report):
+            reply['full_report'] = True
+        return reply
+
+    def _reported_chunk(self, chunk_id):
+        # chunk servers report ids from their directory layout, which
+        # always has the leading '/' a client may have left out
+        if chunk_id in self.blocks.blocks:
+            return chunk_id
+        if chunk_id[1:] in self.blocks.blocks:
+            return chunk_id[1:]
+        return None
 
-        self.cs[cs_addr] = datetime.now()
-        return {'status': Status.ok}
+    def _process_report(self, cs_addr, report):
+        """Reconcile a block report against the block map.
+
+        A listed replica the server no longer has is lost; an unknown chunk
+        is an orphan; a copy of a known chunk on a server not listed for it
+        is taken back while the chunk is short of replicas, if it is no older
+        than the file, and is stale otherwise. Copies already queued for invalidation are left to that
+        queue, and the ones the report shows gone are acknowledged. Returns
+        the chunk ids the server should delete.
+        """
+        if cs_addr not in self.cs:
+            # lost since it sent this; it registers again with a full report
+            return []
+        delete = []
+        queue = []
+        txid = None
+        young = time.time() - self.orphan_grace
+        with self.lock.write():
+            known = {}
+            for reported_id, mtime in report.get('full', report.get('added', ())):
+                chunk_id = self._reported_chunk(reported_id)
+                if chunk_id is not None:
+                    known[chunk_id] = reported_id, mtime
+                elif mtime < young and not self.invalidations.waiting(cs_addr, reported_id):
+                    delete.append(reported_id)
+
+            if 'full' in report:
+                lost = [c for c in self.blocks.chunks_on(cs_addr) if c not in known]
+            else:
+                lost = [c for c in map(self._reported_chunk, report.get('deleted', ())) if c is not None]
+            # deletions the name server asked for were unlisted already
+            lost = [c for c in lost if self.blocks.remove_replica(c, cs_addr)]
+            for chunk_id in lost:
+                txid = self._log_edit({'op': 'unreplica', 'c': chunk_id, 'a': cs_addr})
+                queue.append(chunk_id)
+
+            for chunk_id, (reported_id, mtime) in known.items():
+                info = self.blocks.get(chunk_id)
+                target = self._replication_target(info.file)
+                live = self._live_replicas(info)
+                if cs_addr in info.replicas:
+                    # chunks of a retiring server are fed to the queue at the drain's pace
+                    if live != target and cs_addr not in self.decom:
+                        queue.append(chunk_id)
+                elif self.invalidations.waiting(cs_addr, reported_id):
+                    # already on its way out, e.g. a corrupt copy
+                    continue
+                elif live < target and cs_addr not in self.decom and mtime >= info.file.date:
+                    # ids come from paths: a copy older than the file may be
+                    # left from one deleted while this server was away
+                    self.blocks.add_replica(chunk_id, cs_addr)
+                    txid = self._log_edit({'op': 'replica', 'c': chunk_id, 'a': cs_addr})
+                    if live + 1 != target:
+                        queue.append(chunk_id)
+                elif (chunk_id, cs_addr) not in self.transfers:
+                    delete.append(reported_id)
+
+        if 'full' in report:
+            self.invalidations.keep_only(cs_addr, [c for c, _ in report['full']])
+        else:
+            self.invalidations.ack(cs_addr, report.get('deleted', ()))
+        self._sync_edits(txid)
+        for chunk_id in queue:
+            self.repl.put_in_queue(chunk_id)
+        if lost or delete:
+            print('Block report from', cs_addr, ':', len(lost), 'lost,', len(delete), 'orphan or stale')
+        return delete
 
 
 if __name__ == '__main__':
     host = socket.gethostbyname(socket.gethostname())
-    port = 8888
-    ns = NameNode(dump_on=True)
+    # several name servers can share a host when federated
+    port = int(os.getenv('YAD_NS_PORT', '8888'))
+    workers = int(os.getenv('YAD_NS_WORKERS', '16'))
+    ns = NameNode(dump_on=True, dump_path=os.getenv('YAD_NS_DUMP', './metadata.img'),
+                  replication_workers=int(os.getenv('YAD_REPL_WORKERS', '4')),
+                  balance_bandwidth=int(os.getenv('YAD_BALANCE_BANDWIDTH', str(10 << 20))),
+                  trash_delay=float(os.getenv('YAD_TRASH_DELAY', '0')),
+                  decommission_bandwidth=int(os.getenv('YAD_DECOMMISSION_BANDWIDTH', str(10 << 20))))
     ns.start()
 
-    server = SimpleXMLRPCServer((host, port), logRequests=False)
+    if workers > 0:
+        server = ThreadedXMLRPCServer((host, port), max_workers=workers, logRequests=False)
+    else:
+        server = SimpleXMLRPCServer((host, port), logRequests=False)
     server.register_introspection_functions()
     server.register_instance(ns)
-    server.serve_forever()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        ns.stop()
 
 
 
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3.11
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+from os.path import dirname, abspath
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+from utils.chunk_store import ChunkStore, RECORD
+
+
+def put(store, chunk_id, data):
+    store.put(chunk_id, data, len(data), [zlib.crc32(data)])
+
+
+class DamagedSegmentTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        # room for four chunks per segment
+        store = ChunkStore(self.root, segment_size=4 * (RECORD.size + 100))
+        for i in range(10):
+            put(store, '/c_%d' % i, bytes([i]) * 64)
+        self.sealed = store.segments[0].path
+        self.active = store.active.path
+        del store
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def flip(self, path, offset):
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            byte = f.read(1)
+            f.seek(offset)
+            f.write(bytes([byte[0] ^ 0xff]))
+
+    def test_sealed_segment_keeps_records_past_damage(self):
+        size = os.path.getsize(self.sealed)
+        self.flip(self.sealed, 0)
+        store = ChunkStore(self.root)
+        self.assertEqual(os.path.getsize(self.sealed), size)
+        self.assertNotIn('/c_0', store)
+        for i in range(1, 10):
+            data, _, _ = store.get('/c_%d' % i)
+            self.assertEqual(bytes(data), bytes([i]) * 64)
+
+    def test_active_segment_tail_is_cut_off(self):
+        with open(self.active, 'ab') as f:
+            f.write(b'YADR torn')
+        store = ChunkStore(self.root)
+        self.assertEqual(len(store.chunks()), 10)
+        put(store, '/after', b'x' * 10)
+        del store
+        store = ChunkStore(self.root)
+        self.assertEqual(bytes(store.get('/after')[0]), b'x' * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
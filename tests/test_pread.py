@@ -0,0 +1,84 @@
+#!/usr/bin/env python3.11
+import os
+import sys
+import unittest
+from os.path import dirname, abspath
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+from client.client import Client, Status, ReedSolomon
+
+
+class FakeNameServer:
+    """Just enough of the name server for ec_convert and pread."""
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.info = None
+
+    def get_cs_group(self, count):
+        return {'status': Status.ok, 'cs': self.servers[:count]}
+
+    def convert_to_ec(self, data):
+        self.info = dict(data, status=Status.ok)
+        return {'status': Status.ok}
+
+    def get_file_info(self, path):
+        return self.info
+
+
+class MemoryClient(Client):
+    """A client whose chunk servers are a dict of chunk id -> bytes."""
+
+    def __init__(self, content, servers=3):
+        super().__init__('http://localhost:1')
+        self.content = content
+        self.stored = {}
+        self.lost = set()
+        self.fake_ns = FakeNameServer(['http://cs%d:9999' % i for i in range(servers)])
+
+    def _ns_for(self, path):
+        return self.fake_ns
+
+    def get_file_content(self, path):
+        return Status.ok, self.content
+
+    def _write_chunk(self, addr, chunk_id, data):
+        self.stored[chunk_id] = bytes(data)
+
+    def _read_chunk(self, addr, chunk_id, offset=0, length=0):
+        if chunk_id in self.lost:
+            raise IOError('lost')
+        data = self.stored[chunk_id]
+        return data[offset:offset + length] if length else data[offset:]
+
+
+@unittest.skipIf(ReedSolomon is None, 'erasure coding needs NumPy')
+class ECPreadTest(unittest.TestCase):
+    def setUp(self):
+        # the last group is short, so its shards are too
+        self.data = os.urandom(202643)
+        self.client = MemoryClient(self.data)
+        self.client.ec_convert('/f', 2, 1, 1 << 16)
+
+    def check(self, offset, length):
+        status, got = self.client.pread('/f', offset, length)
+        self.assertEqual(status, Status.ok)
+        self.assertEqual(got, self.data[offset:offset + length])
+
+    def test_tail_group(self):
+        self.check(170000, 100)
+        self.check(70000, 100000)
+        self.check(131072, len(self.data))
+        self.check(len(self.data) - 1, 10)
+
+    def test_tail_group_degraded(self):
+        self.client.lost.add('/f_ec1_0')
+        self.check(170000, 100)
+        self.check(0, len(self.data))
+
+    def test_past_end(self):
+        self.check(len(self.data), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
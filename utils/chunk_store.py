@@ -0,0 +1,302 @@
+#!/usr/bin/env python3.11
+"""Log-structured chunk storage.
+
+Chunks are appended to large segment files instead of getting a file each.
+A record is RECORD (magic, kind, id length, data length, mtime, block size,
+checksum count), the chunk id, the CRC-32 of each checksum block, TRAILER
+(CRC-32 of everything before it) and the data. A delete appends a tombstone:
+a record with no data. The id -> (segment, offset, length) index is kept in
+memory and rebuilt at start by reading the segments in order, later records
+winning; a torn record at the end of the log is cut off. A damaged record in
+a sealed segment is skipped up to the next record whose header checks, and
+left on disk. Reads slice mmaps
+of the segments. compact() copies the live records of a mostly dead sealed
+segment to the end of the log and removes it.
+"""
+import errno
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+RECORD = struct.Struct('<4sBHQdII')
+TRAILER = struct.Struct('<I')
+MAGIC = b'YADR'
+PUT, DELETE = 0, 1
+
+
+class Segment:
+    def __init__(self, path, number):
+        self.path = path
+        self.number = number
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        # bytes of records the index still points to
+        self.live = 0
+        self.map = None
+
+    def view(self, end):
+        """A read-only map of the segment covering at least end bytes."""
+        if self.map is None or len(self.map) < end:
+            # an old map stays valid for the memoryviews still using it
+            self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def __del__(self):
+        os.close(self.fd)
+
+
+class ChunkStore:
+    def __init__(self, root, segment_size=256 << 20, compact_ratio=0.5):
+        self.root = root
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        # chunk id -> (segment, record offset, data offset, size, mtime)
+        self.index = {}
+        self.segments = {}
+        # lock guards the index and segment table; appends also hold
+        # write_lock so readers never wait behind a large write
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        for name in sorted(os.listdir(root)):
+            if name.startswith('segment-') and name.endswith('.yad'):
+                number = int(name[len('segment-'):-len('.yad')])
+                self.segments[number] = Segment(os.path.join(root, name), number)
+        last = max(self.segments, default=None)
+        for seg in sorted(self.segments.values(), key=lambda s: s.number):
+            self._load(seg, seg.number == last)
+        if not self.segments:
+            self.segments[0] = Segment(self._segment_path(0), 0)
+        self.active = self.segments[max(self.segments)]
+
+    @staticmethod
+    def key(chunk_id):
+        return '/' + chunk_id.lstrip('/')
+
+    def _segment_path(self, number):
+        return os.path.join(self.root, 'segment-%08d.yad' % number)
+
+    @staticmethod
+    def _parse(view, offset, end):
+        """RECORD fields and data offset of the record at offset, or None
+        unless its header is whole and its trailer checks."""
+        if offset + RECORD.size > end:
+            return None
+        magic, kind, id_len, size, mtime, block_size, count = RECORD.unpack_from(view, offset)
+        meta_end = offset + RECORD.size + id_len + 4 * count
+        data_offset = meta_end + TRAILER.size
+        if magic != MAGIC or data_offset + size > end or \
+                TRAILER.unpack_from(view, meta_end)[0] != zlib.crc32(view[offset:meta_end]):
+            return None
+        return kind, id_len, size, mtime, data_offset
+
+    def _records(self, seg, resync=False):
+        """(offset, kind, chunk id, data offset, size, mtime) of every whole
+        record in a segment, then the offset where the last of them ends.
+
+        The scan stops at the first bad record unless resync is set; then it
+        goes on from the next record whose header checks, reporting the
+        bytes in between."""
+        if not seg.size:
+            return 0
+        view = seg.view(seg.size)
+        offset = end = 0
+        while offset < seg.size:
+            record = self._parse(view, offset, seg.size)
+            if record is None:
+                if not resync:
+                    break
+                bad = offset
+                offset = view.find(MAGIC, offset + 1)
+                while offset != -1 and self._parse(view, offset, seg.size) is None:
+                    offset = view.find(MAGIC, offset + 1)
+                if offset == -1:
+                    offset = seg.size
+                print('Segment', seg.path, 'is damaged from', bad, 'to', offset, 'bytes, skipping')
+                continue
+            kind, id_len, size, mtime, data_offset = record
+            chunk_id = bytes(view[offset + RECORD.size:offset + RECORD.size + id_len]).decode()
+            yield offset, kind, chunk_id, data_offset, size, mtime
+            offset = end = data_offset + size
+        return end
+
+    def _load(self, seg, active):
+        # only the active segment can end in a write cut short by a crash;
+        # damage anywhere else is skipped, never cut off
+        records = self._records(seg, resync=not active)
+        while True:
+            try:
+                offset, kind, chunk_id, data_offset, size, mtime = next(records)
+            except StopIteration as stop:
+                end = stop.value
+                break
+            self._unlink(chunk_id)
+            if kind == PUT:
+                self.index[chunk_id] = (seg, offset, data_offset, size, mtime)
+                seg.live += data_offset + size - offset
+        if active and end < seg.size:
+            print('Segment', seg.path, 'is torn at', end, 'of', seg.size, 'bytes, truncating')
+            os.ftruncate(seg.fd, end)
+            seg.size = end
+            seg.map = None
+
+    def _unlink(self, chunk_id):
+        """Drop chunk_id from the index, counting its record as dead."""
+        entry = self.index.pop(chunk_id, None)
+        if entry is not None:
+            seg, offset, data_offset, size, _ = entry
+            seg.live -= data_offset + size - offset
+        return entry is not None
+
+    def _append(self, parts):
+        """Write one record at the end of the log; holds write_lock."""
+        length = sum(len(p) for p in parts)
+        seg = self.active
+        if seg.size and seg.size + length > self.segment_size:
+            seg = Segment(self._segment_path(seg.number + 1), seg.number + 1)
+            with self.lock:
+                self.segments[seg.number] = seg
+            self.active = seg
+        offset = seg.size
+        for part in parts:
+            part = memoryview(part)
+            while part:
+                n = os.pwrite(seg.fd, part, seg.size)
+                seg.size += n
+                part = part[n:]
+        return seg, offset
+
+    @staticmethod
+    def _header(kind, chunk_id, size, mtime, block_size, crcs):
+        encoded = chunk_id.encode()
+        meta = RECORD.pack(MAGIC, kind, len(encoded), size, mtime, block_size, len(crcs)) + \
+            encoded + struct.pack('<%dI' % len(crcs), *crcs)
+        return meta + TRAILER.pack(zlib.crc32(meta))
+
+    def put(self, chunk_id, data, block_size, crcs, mtime=None, sync=False):
+        """Store a chunk with the CRC-32 of each of its blocks; returns its mtime."""
+        chunk_id = self.key(chunk_id)
+        mtime = time.time() if mtime is None else mtime
+        header = self._header(PUT, chunk_id, len(data), mtime, block_size, crcs)
+        with self.write_lock:
+            seg, offset = self._append([header, data])
+            with self.lock:
+                self._unlink(chunk_id)
+                self.index[chunk_id] = (seg, offset, offset + len(header), len(data), mtime)
+                seg.live += len(header) + len(data)
+        if sync:
+            os.fsync(seg.fd)
+        return mtime
+
+    def sync(self, first=0):
+        """fsync every segment numbered first or later."""
+        with self.lock:
+            segments = [s for s in self.segments.values() if s.number >= first]
+        for seg in segments:
+            os.fsync(seg.fd)
+
+    def delete(self, chunk_id):
+        """Drop a chunk; False if it was not stored."""
+        chunk_id = self.key(chunk_id)
+        with self.write_lock:
+            with self.lock:
+                if chunk_id not in self.index:
+                    return False
+            self._append([self._header(DELETE, chunk_id, 0, time.time(), 0, [])])
+            with self.lock:
+                self._unlink(chunk_id)
+        return True
+
+    def _entry(self, chunk_id):
+        entry = self.index.get(self.key(chunk_id))
+        if entry is None:
+            raise FileNotFoundError(errno.ENOENT, 'No such chunk', chunk_id)
+        return entry
+
+    def _checksums(self, view, offset):
+        _, _, id_len, _, _, block_size, count = RECORD.unpack_from(view, offset)
+        return block_size, list(struct.unpack_from('<%dI' % count, view, offset + RECORD.size + id_len))
+
+    def get(self, chunk_id):
+        """(memoryview of the data, block size, [crc, ...]) of a chunk."""
+        with self.lock:
+            seg, offset, data_offset, size, _ = self._entry(chunk_id)
+            view = seg.view(data_offset + size)
+        block_size, crcs = self._checksums(view, offset)
+        return memoryview(view)[data_offset:data_offset + size], block_size, crcs
+
+    def locate(self, chunk_id):
+        """(segment, data offset, size, block size, [crc, ...]) of a chunk, for
+        callers that read the segment file themselves, e.g. with sendfile."""
+        with self.lock:
+            seg, offset, data_offset, size, _ = self._entry(chunk_id)
+            view = seg.view(data_offset + size)
+        return (seg, data_offset, size) + self._checksums(view, offset)
+
+    def checksums(self, chunk_id):
+        return self.locate(chunk_id)[3:]
+
+    def __contains__(self, chunk_id):
+        return self.key(chunk_id) in self.index
+
+    def chunks(self):
+        """[chunk id, mtime] of every stored chunk."""
+        with self.lock:
+            return [[chunk_id, entry[4]] for chunk_id, entry in self.index.items()]
+
+    def stats(self):
+        with self.lock:
+            size = sum(s.size for s in self.segments.values())
+            live = sum(s.live for s in self.segments.values())
+            # byte counts as floats: XML-RPC ints stop at 2**31
+            return {'chunks': len(self.index), 'segments': len(self.segments),
+                    'bytes': float(size), 'live': float(live)}
+
+    def compact(self, ratio=None):
+        """Rewrite every sealed segment at least ratio dead; returns the bytes freed."""
+        ratio = self.compact_ratio if ratio is None else ratio
+        with self.lock:
+            victims = [s for s in sorted(self.segments.values(), key=lambda s: s.number)
+                       if s is not self.active and s.size - s.live >= ratio * s.size]
+        freed = 0
+        for seg in victims:
+            view = seg.view(seg.size)
+            written = set()
+            copied = 0
+            for offset, kind, chunk_id, data_offset, size, mtime in self._records(seg, resync=True):
+                record = memoryview(view)[offset:data_offset + size]
+                with self.write_lock:
+                    if kind == PUT:
+                        with self.lock:
+                            entry = self.index.get(chunk_id)
+                            if entry is None or entry[0] is not seg or entry[1] != offset:
+                                continue
+                        # write_lock keeps puts and deletes out until the index moves
+                        target, new_offset = self._append([record])
+                        with self.lock:
+                            self._unlink(chunk_id)
+                            self.index[chunk_id] = (target, new_offset, new_offset + data_offset - offset,
+                                                    size, mtime)
+                            target.live += len(record)
+                    else:
+                        # a tombstone only matters while an older segment may
+                        # still hold a record it cancels, and never once the
+                        # id was stored again: copied to the tail it would
+                        # land after that newer record and delete it on replay
+                        with self.lock:
+                            if min(self.segments) >= seg.number or chunk_id in self.index:
+                                continue
+                        target, _ = self._append([record])
+                written.add(target)
+                copied += len(record)
+            for target in written:
+                os.fsync(target.fd)
+            with self.lock:
+                del self.segments[seg.number]
+            os.remove(seg.path)
+            freed += seg.size - copied
+            print('Compacted segment', seg.path, 'freeing', seg.size - copied, 'bytes')
+        return freed
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3.11
+"""Reed-Solomon erasure coding over GF(256).
+
+A chunk group is k data shards plus m parity shards of equal length; any k
+of the k + m shards rebuild the rest. The generator is the identity on top
+of a k x m Cauchy matrix, so data shards are stored as-is and every k x k
+submatrix is invertible. Shard arithmetic runs on whole NumPy arrays: a
+multiply by a constant is one lookup into a 256 x 256 product table.
+"""
+import numpy as np
+
+POLY = 0x11d
+
+EXP = np.zeros(512, dtype=np.uint8)
+LOG = np.zeros(256, dtype=np.int32)
+_x = 1
+for _i in range(255):
+    EXP[_i] = _x
+    LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= POLY
+EXP[255:510] = EXP[:255]
+
+# MUL[a, b] = a * b in GF(256)
+_logs = LOG[1:, None] + LOG[None, 1:]
+MUL = np.zeros((256, 256), dtype=np.uint8)
+MUL[1:, 1:] = EXP[_logs]
+del _x, _i, _logs
+
+
+def gf_mul(a, b):
+    return int(MUL[a, b])
+
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError('0 has no inverse in GF(256)')
+    return int(EXP[255 - LOG[a]])
+
+
+def gf_invert_matrix(matrix):
+    """Invert a square matrix of GF(256) ints by Gauss-Jordan elimination."""
+    n = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if rows[r][col]), None)
+        if pivot is None:
+            raise ValueError('Singular matrix')
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inv = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(v, inv) for v in rows[col]]
+        for r in range(n):
+            if r != col and rows[r][col]:
+                f = rows[r][col]
+                rows[r] = [v ^ gf_mul(f, p) for v, p in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+class ReedSolomon:
+    def __init__(self, k=6, m=3):
+        if k < 1 or m < 0 or k + m > 256:
+            raise ValueError('RS(%d,%d) needs 1 <= k and k + m <= 256' % (k, m))
+        self.k = k
+        self.m = m
+        # Cauchy rows 1 / (x_i + y_j) with x_i = k + i and y_j = j
+        self.parity = [[gf_inv((k + i) ^ j) for j in range(k)] for i in range(m)]
+
+    def _row(self, index):
+        if index < self.k:
+            return [int(j == index) for j in range(self.k)]
+        return self.parity[index - self.k]
+
+    @staticmethod
+    def _combine(coefs, shards):
+        out = np.zeros(len(shards[0]), dtype=np.uint8)
+        for c, shard in zip(coefs, shards):
+            if c == 1:
+                out ^= shard
+            elif c:
+                out ^= MUL[c][shard]
+        return out
+
+    def split(self, data):
+        """Cut bytes into k equal shards, zero-padding the last one."""
+        size = -(-len(data) // self.k) or 1
+        buf = np.zeros(size * self.k, dtype=np.uint8)
+        buf[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+        return list(buf.reshape(self.k, size))
+
+    def encode(self, shards):
+        """Parity shards for k equal-length data shards (arrays or bytes)."""
+        data = [np.frombuffer(s, dtype=np.uint8) if isinstance(s, (bytes, bytearray)) else s for s in shards]
+        return [self._combine(row, data) for row in self.parity]
+
+    def decode(self, shards, wanted=None):
+        """Rebuild shards from any k of them.
+
+        shards has k + m entries, None where a shard is missing. Returns the
+        shards listed in wanted (default: the k data shards) as arrays.
+        """
+        if wanted is None:
+            wanted = range(self.k)
+        present = [i for i, s in enumerate(shards) if s is not None]
+        if len(present) < self.k:
+            raise ValueError('Need %d shards, have %d' % (self.k, len(present)))
+        use = present[:self.k]
+        have = [np.frombuffer(shards[i], dtype=np.uint8) if isinstance(shards[i], (bytes, bytearray))
+                else shards[i] for i in use]
+
+        decode = None
+        out = []
+        for index in wanted:
+            if shards[index] is not None:
+                out.append(np.frombuffer(shards[index], dtype=np.uint8)
+                           if isinstance(shards[index], (bytes, bytearray)) else shards[index])
+                continue
+            if decode is None:
+                decode = gf_invert_matrix([self._row(i) for i in use])
+            # row of the wanted shard times the inverse maps used shards to it
+            row = self._row(index)
+            coefs = [0] * self.k
+            for j, r in enumerate(row):
+                if r:
+                    for t in range(self.k):
+                        coefs[t] ^= gf_mul(r, decode[j][t])
+            out.append(self._combine(coefs, have))
+        return out
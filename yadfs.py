@@ -5,6 +5,7 @@ from utils.enums import Status, NodeType
 import getpass
 import datetime
 import os
+import sys
 import shutil
 import difflib
 
@@ -39,18 +40,38 @@ def cd(path):
 def ls(path):
     """List directory contents"""
     cl = Client()
-    dir_ls = cl.list_dir(path)
-    stat = dir_ls['status']
-    if stat == Status.ok:
-        for item, info in dir_ls['items'].items():
-            fr = "-rw-r--r--"
-            if info['type'] == NodeType.directory:
-                fr = "drwxr-xr-x"
-            date = datetime.datetime.fromtimestamp(info['date'])
-            date_format = '%b %d %H:%M' if date.year == datetime.datetime.today().year else '%b %d %Y'
-            print('%.11s   %.10s   %6sB   %.15s    %s' % (fr, getpass.getuser(), info['size'],                                datetime.datetime.fromtimestamp(info['date']).strftime(date_format), item))
-    else:
-        print(Status.description(stat))
+    for stat, item, info in cl.iter_dir(path):
+        if stat != Status.ok:
+            print(Status.description(stat))
+            break
+        fr = "-rw-r--r--"
+        if info['type'] == NodeType.directory:
+            fr = "drwxr-xr-x"
+        date = datetime.datetime.fromtimestamp(info['date'])
+        date_format = '%b %d %H:%M' if date.year == datetime.datetime.today().year else '%b %d %Y'
+        print('%.11s   %.10s   %6sB   %.15s    %s' % (fr, getpass.getuser(), info['size'],                                datetime.datetime.fromtimestamp(info['date']).strftime(date_format), item))
+
+@cli.command()
+@click.argument('pattern', default='')
+@click.option('--name', default=None, help='Exact file or directory name')
+@click.option('--ext', default=None, help='File extension, e.g. .gz')
+@click.option('--min-size', type=int, default=None)
+@click.option('--max-size', type=int, default=None)
+@click.option('--newer', type=float, default=None, help='Modified after this unix time')
+@click.option('--older', type=float, default=None, help='Modified before this unix time')
+def find(pattern, name, ext, min_size, max_size, newer, older):
+    """Search the namespace, e.g. find '/logs/2026-*/part-*.gz'"""
+    cl = Client()
+    query = {'pattern': pattern}
+    for key, value in (('name', name), ('ext', ext), ('min_size', min_size), ('max_size', max_size),
+                       ('modified_after', newer), ('modified_before', older)):
+        if value is not None:
+            query[key] = value
+    for stat, info in cl.search(query):
+        if stat != Status.ok:
+            print(Status.description(stat))
+            break
+        print('%10sB   %s' % (info['size'], info['path']))
 
 # @cli.command()#Useless command
 @click.command()
@@ -60,14 +81,14 @@ def pwd():
     print(current_directory)
 
 @cli.command()
-@click.argument('path')
-def mkdir(path):
-    """Create a directory"""
+@click.argument('paths', nargs=-1, required=True)
+def mkdir(paths):
+    """Create directories"""
     cl = Client()
-    res = cl.create_dir(path)
-    stat = res['status']
-    if stat != Status.ok:
-        print(Status.description(stat))
+    for path, res in zip(paths, cl.create_dirs(list(paths))):
+        stat = res['status']
+        if stat != Status.ok:
+            print(path + ': ' + Status.description(stat))
 
 # @cli.command()#Useless command
 @click.argument('source')
@@ -92,7 +113,11 @@ def upload(local_path, remote_path):
     cl = Client()
 
     if os.path.isdir(local_path):
-        print("You can't upload directory as a file")
+        # every file under the directory, metadata calls batched
+        for res in cl.upload_dir(local_path, remote_path):
+            stat = res['status']
+            if stat != Status.ok:
+                print(Status.description(stat))
     else:
         res = cl.create_file(local_path, remote_path)
         stat = res['status']
@@ -100,14 +125,97 @@ def upload(local_path, remote_path):
             print(Status.description(stat))
 
 @cli.command()
+@click.argument('paths', nargs=-1, required=True)
+def rm(paths):
+    """Delete files or directories"""
+    cl = Client()
+    for path, res in zip(paths, cl.delete_many(list(paths))):
+        stat = res['status']
+        if stat != Status.ok:
+            print(path + ': ' + Status.description(stat))
+
+@cli.command()
+@click.argument('replication', type=int)
+@click.argument('paths', nargs=-1, required=True)
+def setrep(replication, paths):
+    """Set the replication factor of files or directories (0 = inherit)"""
+    cl = Client()
+    for path in paths:
+        res = cl.setrep(path, replication)
+        stat = res['status']
+        if stat != Status.ok:
+            print(path + ': ' + Status.description(stat))
+        else:
+            print('%s: replication %d, %d chunks' % (path, res['replication'], res['chunks']))
+
+@cli.group()
+def ec():
+    """Erasure-coded storage"""
+    pass
+
+@ec.command()
 @click.argument('path')
-def rm(path):
-    """Delete a file or directory"""
+@click.option('-k', 'k', type=int, default=6, help='Data shards per group')
+@click.option('-m', 'm', type=int, default=3, help='Parity shards per group')
+def convert(path, k, m):
+    """Store a file, or every file under a directory, as RS(k,m)"""
     cl = Client()
-    res = cl.delete(path)
-    stat = res['status']
-    if stat != Status.ok:
-        print(Status.description(stat))
+    status, info = cl.get_file_info(path)
+    if status != Status.ok:
+        print(path + ': ' + Status.description(status))
+        return
+    if info['type'] == NodeType.directory:
+        files = [i['path'] for stat, i in cl.search({'prefix': path, 'type': NodeType.file})
+                 if stat == Status.ok]
+    else:
+        files = [path]
+    for f in files:
+        res = cl.ec_convert(f, k, m)
+        stat = res['status']
+        if stat != Status.ok:
+            print(f + ': ' + Status.description(stat))
+        else:
+            print('%s: RS(%d,%d)' % (f, k, m))
+
+@cli.group()
+def cs():
+    """Chunk server administration"""
+    pass
+
+@cs.command()
+@click.argument('address')
+def decommission(address):
+    """Drain a chunk server so it can be removed"""
+    res = Client().decommission(address)
+    if res['status'] != Status.ok:
+        print(address + ': ' + Status.description(res['status']))
+    else:
+        print('%s: decommissioning' % address)
+
+@cs.command()
+@click.argument('address')
+def recommission(address):
+    """Put a decommissioned chunk server back in service"""
+    res = Client().recommission(address)
+    if res['status'] != Status.ok:
+        print(address + ': ' + Status.description(res['status']))
+    else:
+        print('%s: in service' % address)
+
+@cs.command()
+@click.argument('address', default='')
+def progress(address):
+    """Show decommissioning progress"""
+    res = Client().decommission_status(address)
+    if res['status'] != Status.ok:
+        print(address + ': ' + Status.description(res['status']))
+        return
+    for addr, node in sorted(res['nodes'].items()):
+        done = node['chunks'] - node['remaining']
+        since = datetime.datetime.fromtimestamp(node['started']).strftime('%b %d %H:%M')
+        print('%s   %-15s   %d/%d chunks copied   since %s%s' % (
+            addr, node['state'], done, node['chunks'], since,
+            '   safe to remove' if node['state'] == 'decommissioned' else ''))
 
 # @cli.command()#useless command
 @click.argument('source')
@@ -184,11 +292,20 @@ def wc(file_path):
 
 @cli.command()
 @click.argument('path')
-def cat(path):
-    """Print a file"""
+@click.option('--offset', type=int, default=0, help='First byte to print')
+@click.option('--length', type=int, default=None, help='Bytes to print (default: to the end)')
+def cat(path, offset, length):
+    """Print a file, or a byte range of it"""
     cl = Client()
-    res = cl.get_file_content(path)
-    print(res)
+    if offset or length is not None:
+        stat, content = cl.pread(path, offset, length if length is not None else sys.maxsize)
+    else:
+        stat, content = cl.get_file_content(path)
+    if stat != Status.ok:
+        print(path + ': ' + Status.description(stat))
+        return
+    sys.stdout.buffer.write(content)
+    sys.stdout.flush()
 
 if __name__ == '__main__':
     cli()